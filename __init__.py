@@ -2,7 +2,7 @@ import glob
 import importlib.util
 import sys
 import os
-from .easyapi import api, logScript, mirrorUrlApply
+from .easyapi import api, logScript, mirrorUrlApply, profiler
 
 extension_folder = os.path.dirname(os.path.realpath(__file__))
 
@@ -24,9 +24,15 @@ def loadCustomNodes():
         file_relative_path = file[len(extension_folder):]
         model_name = file_relative_path.replace(os.sep, '.')
         model_name = os.path.splitext(model_name)[0]
-        module = importlib.import_module(model_name, __name__)
+        try:
+            module = importlib.import_module(model_name, __name__)
+        except Exception as e:
+            # 缺少可选依赖时只跳过这个模块的节点
+            print("[easyapi] fail to load {}, error: {}".format(model_name, e))
+            continue
         if hasattr(module, "NODE_CLASS_MAPPINGS") and getattr(module, "NODE_CLASS_MAPPINGS") is not None:
             NODE_CLASS_MAPPINGS.update(module.NODE_CLASS_MAPPINGS)
+            profiler.wrap_nodes(module.NODE_CLASS_MAPPINGS)
             if hasattr(module, "NODE_DISPLAY_NAME_MAPPINGS") and getattr(module, "NODE_DISPLAY_NAME_MAPPINGS") is not None:
                 NODE_DISPLAY_NAME_MAPPINGS.update(module.NODE_DISPLAY_NAME_MAPPINGS)
         if hasattr(module, "init"):
@@ -0,0 +1,100 @@
+"""
+统计加载本插件的耗时，以及加载后已经导入的重量级依赖
+
+每次测量都启动新的python进程：先导入ComfyUI的nodes、server并创建PromptServer(与ComfyUI启动时相同)，再加载本插件，
+只统计加载插件的耗时。
+
+在ComfyUI根目录下执行：
+    python custom_nodes/comfyui-easyapi-nodes/benchmarks/import_time.py
+    python custom_nodes/comfyui-easyapi-nodes/benchmarks/import_time.py --importtime  # 输出耗时最多的导入
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+HEAVY_MODULES = ["segment_anything", "pycocotools", "simple_lama_inpainting", "git", "cv2", "requests", "aiohttp"]
+
+CHILD = """
+import asyncio, importlib.util, json, os, sys, time
+sys.path.insert(0, os.getcwd())
+import nodes, server, execution, folder_paths
+loop = asyncio.new_event_loop()
+asyncio.set_event_loop(loop)
+server.PromptServer(loop)
+before = set(sys.modules)
+sys.stderr.write("EASYAPI_START\n")
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location("easyapi_nodes", os.path.join({repo_dir!r}, "__init__.py"),
+                                              submodule_search_locations=[{repo_dir!r}])
+module = importlib.util.module_from_spec(spec)
+sys.modules["easyapi_nodes"] = module
+spec.loader.exec_module(module)
+elapsed = time.perf_counter() - start
+loaded = [name for name in {heavy!r} if name in sys.modules and name not in before]
+sys.__stdout__.write("RESULT " + json.dumps({{"seconds": elapsed, "nodes": len(module.NODE_CLASS_MAPPINGS),
+                                               "loaded": loaded}}) + "\\n")
+sys.__stdout__.flush()
+os._exit(0)
+"""
+
+
+def run_once(importtime=False):
+    code = CHILD.format(repo_dir=repo_dir, heavy=HEAVY_MODULES)
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    process = subprocess.run(command + ["-c", code], capture_output=True, text=True)
+    result = None
+    for line in process.stdout.splitlines():
+        if line.startswith("RESULT "):
+            result = json.loads(line[len("RESULT "):])
+    if result is None:
+        raise RuntimeError(process.stderr[-2000:])
+    return result, process.stderr
+
+
+def print_importtime(stderr, top):
+    """
+    按累计耗时输出插件加载期间导入的模块
+    """
+    entries = []
+    # 只统计插件加载期间的导入
+    stderr = stderr[stderr.find("EASYAPI_START"):]
+    for line in stderr.splitlines():
+        # 插件替换了sys.stderr，行首可能带有时间前缀
+        index = line.find("import time:")
+        if index < 0 or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[index + len("import time:"):].split("|")
+        entries.append((int(cumulative_us), name.rstrip()))
+    for cumulative_us, name in sorted(entries, reverse=True)[:top]:
+        print("  {:10.1f} ms  {}".format(cumulative_us / 1000, name))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--importtime", action="store_true")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    seconds = []
+    result = None
+    for _ in range(args.runs):
+        result, _ = run_once()
+        seconds.append(result["seconds"])
+    print("load easyapi nodes: median {:.1f} ms, min {:.1f} ms, max {:.1f} ms ({} runs, {} nodes)".format(
+        statistics.median(seconds) * 1000, min(seconds) * 1000, max(seconds) * 1000, args.runs, result["nodes"]))
+    print("heavy modules imported by easyapi: {}".format(", ".join(result["loaded"]) or "none"))
+    if args.importtime:
+        _, stderr = run_once(importtime=True)
+        print_importtime(stderr, args.top)
+
+
+if __name__ == "__main__":
+    main()
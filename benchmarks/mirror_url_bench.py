@@ -0,0 +1,64 @@
+"""
+镜像地址查找的单次调用耗时对比(旧实现：每次读取配置文件+deepcopy+线性查找；
+新实现：mirror_candidates，检查配置版本号后查编译好的镜像表)
+
+在ComfyUI根目录下执行：
+    python custom_nodes/comfyui-easyapi-nodes/benchmarks/mirror_url_bench.py
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import timeit
+from urllib.parse import urlparse
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, repo_dir)
+
+from easyapi import mirrorUrlApply  # noqa: E402
+from easyapi.mirrorUrlApply import Mirror, mirror_url, mirror_candidates  # noqa: E402
+from easyapi.settings import check_dir  # noqa: E402
+
+
+def legacy_replace_url(url, mirror_type=Mirror.DOWN_MODEL):
+    """
+    旧实现：每次调用都读取配置文件、deepcopy镜像列表并线性查找
+    """
+    config_file = check_dir("config/easyapi.json")
+    with open(config_file, 'r+', encoding="utf-8") as file:
+        settings = json.load(file)
+    base_mirrors = copy.deepcopy(mirror_url)
+    if settings and 'huggingface_mirror' in settings:
+        base_mirrors[1]['n_url'] = settings['huggingface_mirror']
+    if settings and 'rawgithub_mirror' in settings:
+        base_mirrors[0]['n_url'] = settings['rawgithub_mirror']
+    if settings and 'github_mirror' in settings:
+        base_mirrors[2]['n_url'] = settings['github_mirror']
+    u = urlparse(url)
+    netloc = u.netloc
+    for mirror in base_mirrors:
+        if netloc is not None and len(netloc) > 0 and netloc.lower() == mirror['o_url'] and mirror['n_url'] != 'None':
+            return True, u._replace(netloc=mirror['n_url']), mirror.get('u_agent')
+    return False, u, None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    # 未配置镜像的域名，绝大多数请求走这个分支，不会触发替换日志
+    urls = ["https://example.com/api/v1/items?id=1", "https://pypi.org/simple/torch/"]
+    # 预热，生成镜像表
+    mirrorUrlApply.get_mirror_table(Mirror.DOWN_MODEL)
+    for url in urls:
+        legacy = timeit.timeit(lambda: legacy_replace_url(url), number=args.number) / args.number
+        compiled = timeit.timeit(lambda: mirror_candidates(url, Mirror.DOWN_MODEL), number=args.number) / args.number
+        print("{}\n  legacy: {:8.2f} us/call\n  compiled: {:6.2f} us/call\n  speedup: {:.1f}x".format(
+            url, legacy * 1e6, compiled * 1e6, legacy / compiled))
+
+
+if __name__ == "__main__":
+    main()
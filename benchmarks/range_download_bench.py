@@ -0,0 +1,102 @@
+"""
+分段并发下载与单连接下载的耗时对比，使用本地支持Range的HTTP服务器，每个连接限速模拟远程服务器
+
+在ComfyUI根目录下执行：
+    python custom_nodes/comfyui-easyapi-nodes/benchmarks/range_download_bench.py
+"""
+import argparse
+import hashlib
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, repo_dir)
+
+import requests  # noqa: E402
+from easyapi import downloader  # noqa: E402
+
+
+def make_handler(content, rate):
+    digest = hashlib.sha256(content).hexdigest()
+
+    class RangeHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", '"{}"'.format(digest))
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+
+        def do_GET(self):
+            start, end = 0, len(content) - 1
+            match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if match:
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else end
+                self.send_response(206)
+                self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, len(content)))
+            else:
+                self.send_response(200)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", '"{}"'.format(digest))
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            # 每个连接按rate字节/秒发送
+            chunk = 64 * 1024
+            for offset in range(start, end + 1, chunk):
+                try:
+                    self.wfile.write(content[offset:min(offset + chunk, end + 1)])
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                time.sleep(chunk / rate)
+
+    return RangeHandler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=32, help="文件大小MB")
+    parser.add_argument("--rate", type=float, default=8, help="单个连接的速度MB/s")
+    parser.add_argument("--connections", type=int, default=8)
+    parser.add_argument("--part-size", type=int, default=4, help="分段大小MB")
+    args = parser.parse_args()
+
+    content = os.urandom(args.size * 1024 * 1024)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(content, args.rate * 1024 * 1024))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/model.bin".format(server.server_address[1])
+    session = requests.Session()
+
+    start = time.perf_counter()
+    single = session.get(url).content
+    single_time = time.perf_counter() - start
+    assert single == content
+
+    start = time.perf_counter()
+    response = session.get(url, stream=True)
+    get_range = downloader.requests_range_getter(session, url, None, requests.Session.request)
+    task = downloader.RangeDownloader(url, int(response.headers["Content-Length"]), get_range,
+                                      downloader.expected_sha256(response.headers), response.headers.get("ETag"))
+    response.close()
+    task.connections = args.connections
+    task.part_size = args.part_size * 1024 * 1024
+    path = task.download()
+    parallel_time = time.perf_counter() - start
+    with downloader.DownloadedFile(path) as f:
+        assert f.read() == content
+
+    print("{} MB, {} MB/s per connection\n  single: {:6.2f} s\n  parallel({}): {:6.2f} s\n  speedup: {:.1f}x".format(
+        args.size, args.rate, single_time, args.connections, parallel_time, single_time / parallel_time))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+URL磁盘缓存的条件请求测试和耗时对比，使用本地HTTP服务器，检查ETag/Last-Modified条件请求、304和统计计数，
+并对比首次下载和304重新验证的耗时
+
+在ComfyUI根目录下执行：
+    python custom_nodes/comfyui-easyapi-nodes/benchmarks/url_cache_bench.py
+"""
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, repo_dir)
+
+import requests  # noqa: E402
+from easyapi.urlCache import UrlDiskCache  # noqa: E402
+
+
+class Files:
+    """
+    服务器上的文件，key是路径，值是(内容, 是否返回ETag, 是否返回Last-Modified, 修改时间)
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def put(self, path, content, etag=True, last_modified=True):
+        self.files[path] = (content, etag, last_modified, time.time())
+
+    def log(self, path, status, headers):
+        with self._lock:
+            self.requests.append((path, status, headers))
+
+
+def make_handler(files, rate):
+    class CacheHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            content, etag, last_modified, mtime = files.files[self.path]
+            etag_value = '"{}"'.format(hashlib.sha256(content).hexdigest()) if etag else None
+            modified_value = formatdate(int(mtime), usegmt=True) if last_modified else None
+            conditional = {key: self.headers[key] for key in ("If-None-Match", "If-Modified-Since") if self.headers[key]}
+            not_modified = False
+            if etag_value is not None and "If-None-Match" in conditional:
+                not_modified = conditional["If-None-Match"] == etag_value
+            elif modified_value is not None and "If-Modified-Since" in conditional:
+                not_modified = conditional["If-Modified-Since"] == modified_value
+            status = 304 if not_modified else 200
+            files.log(self.path, status, conditional)
+            self.send_response(status)
+            if etag_value is not None:
+                self.send_header("ETag", etag_value)
+            if modified_value is not None:
+                self.send_header("Last-Modified", modified_value)
+            if not_modified:
+                self.end_headers()
+                return
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            # 按rate字节/秒发送，模拟远程服务器
+            chunk = 64 * 1024
+            for offset in range(0, len(content), chunk):
+                try:
+                    self.wfile.write(content[offset:offset + chunk])
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+                time.sleep(chunk / rate)
+
+    return CacheHandler
+
+
+def check_conditional_requests(cache, session, files, base_url):
+    files.put("/etag.png", os.urandom(1024), last_modified=False)
+    files.put("/modified.png", os.urandom(1024), etag=False)
+    files.put("/none.png", os.urandom(1024), etag=False, last_modified=False)
+
+    for path, header in (("/etag.png", "If-None-Match"), ("/modified.png", "If-Modified-Since")):
+        content, digest = cache.fetch(base_url + path, session)
+        assert content == files.files[path][0] and digest == hashlib.sha256(content).hexdigest()
+        assert files.requests[-1] == (path, 200, {})
+        assert cache.fetch(base_url + path, session)[0] == content
+        assert files.requests[-1][1] == 304 and header in files.requests[-1][2], files.requests[-1]
+
+    # 内容变化后返回200，使用新的内容
+    files.put("/etag.png", os.urandom(1024), last_modified=False)
+    content, _ = cache.fetch(base_url + "/etag.png", session)
+    assert content == files.files["/etag.png"][0] and files.requests[-1][1] == 200
+
+    # 没有ETag和Last-Modified的响应不缓存，每次都不带条件请求头
+    cache.fetch(base_url + "/none.png", session)
+    cache.fetch(base_url + "/none.png", session)
+    assert files.requests[-1] == ("/none.png", 200, {})
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["revalidated"], stats["misses"]) == (2, 2, 5), stats
+
+
+def check_concurrent_stats(cache, session, files, base_url, workers, count):
+    files.put("/concurrent.png", os.urandom(1024))
+    before = cache.stats()
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(lambda _: cache.fetch(base_url + "/concurrent.png", session), range(count)))
+    stats = cache.stats()
+    assert stats["hits"] + stats["misses"] - before["hits"] - before["misses"] == count, stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=8, help="文件大小MB")
+    parser.add_argument("--rate", type=float, default=32, help="服务器速度MB/s")
+    parser.add_argument("--workers", type=int, default=8, help="并发请求的线程数")
+    parser.add_argument("--number", type=int, default=5)
+    args = parser.parse_args()
+
+    files = Files()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(files, args.rate * 1024 * 1024))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "http://127.0.0.1:{}".format(server.server_address[1])
+    session = requests.Session()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = UrlDiskCache("url_bench", cache_dir)
+        check_conditional_requests(cache, session, files, base_url)
+        check_concurrent_stats(cache, session, files, base_url, args.workers, args.workers * 50)
+        print("conditional requests and stats: ok")
+
+        files.put("/large.png", os.urandom(args.size * 1024 * 1024))
+        start = time.perf_counter()
+        content, _ = cache.fetch(base_url + "/large.png", session)
+        cold_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(args.number):
+            assert cache.fetch(base_url + "/large.png", session)[0] == content
+        revalidate_time = (time.perf_counter() - start) / args.number
+        print("{} MB, {} MB/s\n  download: {:8.2f} ms\n  304 revalidate: {:8.2f} ms\n  speedup: {:.1f}x".format(
+            args.size, args.rate, cold_time * 1000, revalidate_time * 1000, cold_time / revalidate_time))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,8 @@
 import os
 
-from PIL import Image
 from json import JSONEncoder
-import numpy as np
 
-from .util import tensor_to_pil, pil_to_tensor, hex_to_rgba
+from .util import tensor_to_uint8, pil_to_tensor, hex_to_rgba
 
 import folder_paths
 
@@ -57,7 +55,7 @@ class InsightFaceBBOXDetect:
             else:
                 model = self.models['insightface']
 
-        img = cv2.cvtColor(np.array(tensor_to_pil(image)), cv2.COLOR_RGB2BGR)
+        img = cv2.cvtColor(tensor_to_uint8(image)[0], cv2.COLOR_RGB2BGR)
         faces = model.get(img)
         if num_sort == 'reactor' or num_sort == 'left-right':
             faces = sorted(faces, key=lambda x: x.bbox[0])
@@ -76,7 +74,7 @@ class InsightFaceBBOXDetect:
         n_r, n_g, n_b, n_a = hex_to_rgba(num_color)
 
         img_with_bbox, bbox = draw_on(img, faces, shape=shape, show_num=show_num, num_pos=num_pos, shape_color=(b, g, r), font_color=(n_b, n_g, n_r))
-        img_with_bbox = Image.fromarray(cv2.cvtColor(img_with_bbox, cv2.COLOR_BGR2RGB))
+        img_with_bbox = cv2.cvtColor(img_with_bbox, cv2.COLOR_BGR2RGB)
 
         bbox_json = JSONEncoder().encode(bbox)
         return pil_to_tensor(img_with_bbox), bbox_json, len(bbox), model
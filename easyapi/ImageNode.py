@@ -1,11 +1,9 @@
-import base64
 import copy
-import io
 import os
 
 import numpy as np
 import torch
-from PIL import ImageOps, Image, ImageSequence
+from PIL import ImageOps, Image
 
 import folder_paths
 import node_helpers
@@ -14,7 +12,18 @@ from comfy.cli_args import args
 from PIL.PngImagePlugin import PngInfo
 import json
 from json import JSONEncoder, JSONDecoder
-from .util import tensor_to_pil, pil_to_tensor, base64_to_image, image_to_base64, read_image_from_url, check_directory
+from .util import tensor_to_pil, tensor_to_uint8, pil_to_tensor, pils_to_tensors, pil_to_mask, base64_to_image, image_to_base64, image_to_bytes, read_images_from_urls, \
+    check_directory, save_image, encode_in_pool, image_formats
+from .blobStore import read_image_from_blob, result_store, put_blob
+from .cache import LRUCache, sizeof_tensors
+
+# 本地图片解码后的张量缓存，key是(路径, 修改时间, 文件大小, 通道)
+local_file_cache = LRUCache("local_file", "local_file_cache_max_size", 512, sizeof=sizeof_tensors)
+
+
+def local_file_cache_key(image_path, channel):
+    stat = os.stat(image_path)
+    return os.path.realpath(image_path), stat.st_mtime_ns, stat.st_size, channel
 
 
 class LoadImageFromURL:
@@ -39,24 +48,28 @@ class LoadImageFromURL:
     OUTPUT_IS_LIST = (True, True,)
 
     def convert(self, urls):
-        urls = urls.splitlines()
+        urls = [url.strip() for url in urls.splitlines() if len(url.strip()) > 0]
+
+        def to_tensor(i):
+            i = ImageOps.exif_transpose(i)
+            if i.mode == 'I':
+                i = i.point(lambda i: i * (1 / 255))
+            image = pil_to_tensor(i.convert("RGB"))
+            if 'A' in i.getbands():
+                mask = pil_to_mask(i, 'A')
+            else:
+                mask = torch.zeros((64, 64), dtype=torch.float32, device="cpu")
+            return image, mask.unsqueeze(0)
+
+        # 并发下载和解码
+        results = read_images_from_urls(urls, convert=to_tensor, convert_key="image")
         images = []
         masks = []
-        for url in urls:
-            if not url.strip().isspace():
-                i = read_image_from_url(url.strip())
-                i = ImageOps.exif_transpose(i)
-                if i.mode == 'I':
-                    i = i.point(lambda i: i * (1 / 255))
-                image = i.convert("RGB")
-                image = pil_to_tensor(image)
-                images.append(image)
-                if 'A' in i.getbands():
-                    mask = np.array(i.getchannel('A')).astype(np.float32) / 255.0
-                    mask = 1. - torch.from_numpy(mask)
-                else:
-                    mask = torch.zeros((64, 64), dtype=torch.float32, device="cpu")
-                masks.append(mask.unsqueeze(0))
+        for (url, result) in zip(urls, results):
+            if result is None:
+                raise RuntimeError(f"fail to load image from url: {url}")
+            images.append(result[0])
+            masks.append(result[1])
 
         return (images, masks, )
 
@@ -87,24 +100,25 @@ class LoadMaskFromURL:
     OUTPUT_IS_LIST = (True, True,)
 
     def convert(self, urls, channel=_color_channels[0]):
-        urls = urls.splitlines()
-        masks = []
-        for url in urls:
-            if not url.strip().isspace():
-                i = read_image_from_url(url.strip())
-                # 下面代码参考LoadImage
-                i = ImageOps.exif_transpose(i)
-                if i.getbands() != ("R", "G", "B", "A"):
-                    i = i.convert("RGBA")
-                c = channel[0].upper()
-                if c in i.getbands():
-                    mask = np.array(i.getchannel(c)).astype(np.float32) / 255.0
-                    mask = torch.from_numpy(mask)
-                    if c == 'A':
-                        mask = 1. - mask
-                else:
-                    mask = torch.zeros((64, 64), dtype=torch.float32, device="cpu")
-                masks.append(mask.unsqueeze(0))
+        urls = [url.strip() for url in urls.splitlines() if len(url.strip()) > 0]
+        c = channel[0].upper()
+
+        def to_mask(i):
+            # 下面代码参考LoadImage
+            i = ImageOps.exif_transpose(i)
+            if i.getbands() != ("R", "G", "B", "A"):
+                i = i.convert("RGBA")
+            if c in i.getbands():
+                mask = pil_to_mask(i, c)
+            else:
+                mask = torch.zeros((64, 64), dtype=torch.float32, device="cpu")
+            return mask.unsqueeze(0)
+
+        # 并发下载和解码
+        masks = read_images_from_urls(urls, convert=to_mask, convert_key="mask_" + c)
+        for (url, mask) in zip(urls, masks):
+            if mask is None:
+                raise RuntimeError(f"fail to load image from url: {url}")
         return (masks,)
 
 
@@ -138,18 +152,60 @@ class Base64ToImage:
             i = base64_to_image(base64Image)
             # 下面代码参考LoadImage
             i = ImageOps.exif_transpose(i)
-            image = i.convert("RGB")
-            image = np.array(image).astype(np.float32) / 255.0
-            image = torch.from_numpy(image)[None, ]
             if 'A' in i.getbands():
-                mask = np.array(i.getchannel('A')).astype(np.float32) / 255.0
-                mask = 1. - torch.from_numpy(mask)
+                mask = pil_to_mask(i, 'A')
+            else:
+                mask = torch.zeros((64, 64), dtype=torch.float32, device="cpu")
+            images.append(i.convert("RGB"))
+            masks.append(mask.unsqueeze(0))
+
+        # 尺寸相同的图片解码到同一个张量中
+        return (pils_to_tensors(images), masks,)
+
+
+class LoadImageFromBlob:
+    """
+    读取通过/easyapi/blob接口上传的图片
+    """
+    @classmethod
+    def INPUT_TYPES(self):
+        return {"required": {
+            "blob_ids": ("STRING", {"multiline": True, "default": "", "dynamicPrompts": False, "tooltip": "上传接口返回的id，一行代表一个图片"}),
+        },
+        }
+
+    RETURN_TYPES = ("IMAGE", "MASK")
+    RETURN_NAMES = ("images", "masks")
+
+    FUNCTION = "convert"
+
+    CATEGORY = "EasyApi/Image"
+
+    DESCRIPTION = "读取通过/easyapi/blob接口上传的图片，图片不需要经过base64编码和json解析"
+    # INPUT_IS_LIST = False
+    OUTPUT_IS_LIST = (True, True,)
+
+    def convert(self, blob_ids):
+        images = []
+        masks = []
+        for blob_id in blob_ids.splitlines():
+            blob_id = blob_id.strip()
+            if len(blob_id) == 0:
+                continue
+            i = read_image_from_blob(blob_id)
+            # 下面代码参考LoadImage
+            i = ImageOps.exif_transpose(i)
+            if i.mode == 'I':
+                i = i.point(lambda i: i * (1 / 255))
+            if 'A' in i.getbands():
+                mask = pil_to_mask(i, 'A')
             else:
                 mask = torch.zeros((64, 64), dtype=torch.float32, device="cpu")
-            images.append(image)
+            images.append(i.convert("RGB"))
             masks.append(mask.unsqueeze(0))
 
-        return (images, masks,)
+        # 尺寸相同的图片解码到同一个张量中
+        return (pils_to_tensors(images), masks,)
 
 
 class ImageToBase64Advanced:
@@ -162,6 +218,12 @@ class ImageToBase64Advanced:
             "images": ("IMAGE",),
             "imageType": (["image", "mask"], {"default": "image"}),
         },
+            "optional": {
+                "output_mode": (["base64", "blob"], {"default": "base64", "tooltip": "blob: 图片数据保存在服务端，消息中只返回id和获取地址(/easyapi/result/{id})，减少websocket和历史记录的数据量"}),
+                "image_format": (list(image_formats.keys()), {"default": "png", "tooltip": "编码格式，只有png会保存元数据"}),
+                "compress_level": ("INT", {"default": 6, "min": 0, "max": 9, "step": 1, "tooltip": "png压缩等级，越大文件越小，编码越慢"}),
+                "quality": ("INT", {"default": 90, "min": 1, "max": 100, "step": 1, "tooltip": "webp和jpeg的质量"}),
+            },
             "hidden": {"prompt": "PROMPT", "extra_pnginfo": "EXTRA_PNGINFO"},
         }
 
@@ -178,32 +240,46 @@ class ImageToBase64Advanced:
     # INPUT_IS_LIST = False
     # OUTPUT_IS_LIST = (False,False,)
 
-    def convert(self, images, imageType=None, prompt=None, extra_pnginfo=None):
+    def convert(self, images, imageType=None, output_mode="base64", image_format="png", compress_level=6, quality=90,
+                prompt=None, extra_pnginfo=None):
         if imageType is None:
             imageType = self.imageType
 
-        result = list()
-        for i in images:
-            img = tensor_to_pil(i)
-            metadata = None
-            if not args.disable_metadata:
-                metadata = PngInfo()
-                if prompt is not None:
-                    newPrompt = copy.deepcopy(prompt)
-                    for idx in newPrompt:
-                        node = newPrompt[idx]
-                        if node['class_type'] == 'Base64ToImage' or node['class_type'] == 'Base64ToMask':
-                            node['inputs']['base64Images'] = ""
-                    metadata.add_text("prompt", json.dumps(newPrompt))
-                if extra_pnginfo is not None:
-                    for x in extra_pnginfo:
-                        metadata.add_text(x, json.dumps(extra_pnginfo[x]))
-
+        # 同一批图片的元数据相同，只生成一次
+        metadata = None
+        if not args.disable_metadata and image_format == "png":
+            metadata = PngInfo()
+            if prompt is not None:
+                newPrompt = copy.deepcopy(prompt)
+                for idx in newPrompt:
+                    node = newPrompt[idx]
+                    if node['class_type'] == 'Base64ToImage' or node['class_type'] == 'Base64ToMask':
+                        node['inputs']['base64Images'] = ""
+                metadata.add_text("prompt", json.dumps(newPrompt))
+            if extra_pnginfo is not None:
+                for x in extra_pnginfo:
+                    metadata.add_text(x, json.dumps(extra_pnginfo[x]))
+
+        def encode(i):
+            img = Image.fromarray(i.squeeze())
+            if output_mode == "blob":
+                return image_to_bytes(img, pnginfo=metadata, image_format=image_format, compress_level=compress_level, quality=quality)
             # 将图像数据编码为Base64字符串
-            encoded_image = image_to_base64(img, pnginfo=metadata)
-            result.append(encoded_image)
+            return image_to_base64(img, pnginfo=metadata, image_format=image_format, compress_level=compress_level, quality=quality)
+
+        # 整个批次一次性量化为uint8
+        result = encode_in_pool(encode, tensor_to_uint8(images))
+        if output_mode == "blob":
+            for (index, data) in enumerate(result):
+                blob_id = put_blob(result_store, data, image_formats[image_format][1])
+                if blob_id is None:
+                    raise RuntimeError("image too large for result store")
+                result[index] = blob_id
         base64Images = JSONEncoder().encode(result)
         # print(images)
+        if output_mode == "blob":
+            urls = ["/easyapi/result/" + blob_id for blob_id in result]
+            return {"ui": {"blobIds": result, "blobUrls": urls, "imageType": [imageType]}, "result": (base64Images,)}
         return {"ui": {"base64Images": result, "imageType": [imageType]}, "result": (base64Images,)}
 
 
@@ -305,10 +381,7 @@ class Base64ToMask:
             mask = None
             c = channel[0].upper()
             if c in i.getbands():
-                mask = np.array(i.getchannel(c)).astype(np.float32) / 255.0
-                mask = torch.from_numpy(mask)
-                if c == 'A':
-                    mask = 1. - mask
+                mask = pil_to_mask(i, c)
             else:
                 mask = torch.zeros((64,64), dtype=torch.float32, device="cpu")
 
@@ -331,17 +404,9 @@ class LoadImageToBase64(LoadImage):
         img, mask = self.load_image(image)
 
         i = tensor_to_pil(img)
-        # 创建一个BytesIO对象，用于临时存储图像数据
-        image_data = io.BytesIO()
-
-        # 将图像保存到BytesIO对象中，格式为PNG
-        i.save(image_data, format='PNG')
-
-        # 将BytesIO对象的内容转换为字节串
-        image_data_bytes = image_data.getvalue()
 
         # 将图像数据编码为Base64字符串
-        encoded_image = "[\"data:image/png;base64," + base64.b64encode(image_data_bytes).decode('utf-8') + "\"]"
+        encoded_image = JSONEncoder().encode([image_to_base64(i)])
         return encoded_image, img, mask
 
 
@@ -352,63 +417,76 @@ class LoadImageFromLocalPath:
                     {
                         "image_path": ("STRING", {"default": ""},)
                     },
+                "optional":
+                    {
+                        "frame_start": ("INT", {"default": 0, "min": 0, "max": 0xffffffff, "step": 1, "tooltip": "多帧图片(gif/webp/tiff等)从第几帧开始读取，从0开始"}),
+                        "frame_count": ("INT", {"default": 0, "min": 0, "max": 0xffffffff, "step": 1, "tooltip": "最多读取多少帧，0表示读取全部"}),
+                        "frame_stride": ("INT", {"default": 1, "min": 1, "max": 0xffffffff, "step": 1, "tooltip": "每隔多少帧读取一帧"}),
+                    },
                 }
 
     CATEGORY = "EasyApi/Image"
 
     RETURN_TYPES = ("IMAGE", "MASK")
     FUNCTION = "load_image"
-    def load_image(self, image_path):
-
+    def load_image(self, image_path, frame_start=0, frame_count=0, frame_stride=1):
+        key = local_file_cache_key(image_path, ("image", frame_start, frame_count, frame_stride))
+        result = local_file_cache.get(key)
+        if result is None:
+            result = self._load_image(image_path, frame_start, frame_count, frame_stride)
+            local_file_cache.put(key, result)
+        return result
+
+    def _load_image(self, image_path, frame_start=0, frame_count=0, frame_stride=1):
         img = node_helpers.pillow(Image.open, image_path)
 
-        output_images = []
-        output_masks = []
-        w, h = None, None
-
         excluded_formats = ['MPO']
-        # 遍历图像的每一帧
-        for i in ImageSequence.Iterator(img):
+        # MPO格式只读取第一帧
+        n_frames = 1 if img.format in excluded_formats else getattr(img, "n_frames", 1)
+        frame_indexes = range(frame_start, n_frames, max(1, frame_stride))
+        if frame_count > 0:
+            frame_indexes = frame_indexes[:frame_count]
+        if len(frame_indexes) == 0:
+            raise ValueError(f"frame_start {frame_start} out of range, image has {n_frames} frames")
+
+        # 根据帧数一次性分配输出张量，逐帧写入，避免先生成每帧的张量再拼接
+        output_image = None
+        output_mask = None
+        w, h = None, None
+        count = 0
+        for frame_index in frame_indexes:
+            img.seek(frame_index)
             # 旋转图像
-            i = node_helpers.pillow(ImageOps.exif_transpose, i)
+            i = node_helpers.pillow(ImageOps.exif_transpose, img)
 
             if i.mode == 'I':
                 i = i.point(lambda i: i * (1 / 255))
             # 将图像转换为RGB格式
             image = i.convert("RGB")
 
-            if len(output_images) == 0:
+            if output_image is None:
                 w = image.size[0]
                 h = image.size[1]
+                output_image = torch.empty((len(frame_indexes), h, w, 3), dtype=torch.float32)
 
             if image.size[0] != w or image.size[1] != h:
                 continue
 
-            # 将图像转换为浮点数组 (H,W,Channel)
-            image = np.array(image).astype(np.float32) / 255.0
-            # 先把图片转成3维张量，并再在最前面添加一个维度，变成4维(1, H, W,Channel)
-            image = torch.from_numpy(image)[None,]
-            # 如果图像包含alpha通道，则将其转换为掩码
+            output_image[count].copy_(torch.from_numpy(np.array(image)))
+            # 如果图像包含alpha通道，则将其转换为掩码(透明像素为1)
             if 'A' in i.getbands():
-                # 计算后结果数组中透明像素会是0
-                mask = np.array(i.getchannel('A')).astype(np.float32) / 255.0
-                # 把数组中透明像素设为1
-                mask = 1. - torch.from_numpy(mask)
-            else:
-                # 否则，创建一个64x64的零张量作为掩码
-                mask = torch.zeros((64, 64,), dtype=torch.float32, device="cpu")
-            # 将图像和掩码添加到输出列表中
-            output_images.append(image)
-            output_masks.append(mask.unsqueeze(0))
-
-        if len(output_images) > 1 and img.format not in excluded_formats:
-            # 如果有多个图像，则将它们按维度0拼接在一起
-            output_image = torch.cat(output_images, dim=0)
-            output_mask = torch.cat(output_masks, dim=0)
-        # 否则，返回单个图像和掩码
-        else:
-            output_image = output_images[0]
-            output_mask = output_masks[0]
+                if output_mask is None:
+                    output_mask = torch.zeros((len(frame_indexes), h, w), dtype=torch.float32)
+                output_mask[count] = pil_to_mask(i, 'A')
+            count += 1
+
+        output_image = output_image[:count] if count < len(frame_indexes) else output_image
+        output_image.div_(255.0)
+        if output_mask is None:
+            # 没有alpha通道时，所有帧共用一次分配的64x64零张量作为掩码
+            output_mask = torch.zeros((count, 64, 64), dtype=torch.float32, device="cpu")
+        elif count < len(frame_indexes):
+            output_mask = output_mask[:count]
         # 返回输出图像和掩码
         return (output_image, output_mask)
 
@@ -429,6 +507,14 @@ class LoadMaskFromLocalPath:
     RETURN_TYPES = ("MASK",)
     FUNCTION = "load_mask"
     def load_mask(self, image_path, channel):
+        key = local_file_cache_key(image_path, channel)
+        result = local_file_cache.get(key)
+        if result is None:
+            result = self._load_mask(image_path, channel)
+            local_file_cache.put(key, result)
+        return result
+
+    def _load_mask(self, image_path, channel):
         i = node_helpers.pillow(Image.open, image_path)
         i = node_helpers.pillow(ImageOps.exif_transpose, i)
         if i.getbands() != ("R", "G", "B", "A"):
@@ -438,10 +524,7 @@ class LoadMaskFromLocalPath:
         mask = None
         c = channel[0].upper()
         if c in i.getbands():
-            mask = np.array(i.getchannel(c)).astype(np.float32) / 255.0
-            mask = torch.from_numpy(mask)
-            if c == 'A':
-                mask = 1. - mask
+            mask = pil_to_mask(i, c)
         else:
             mask = torch.zeros((64, 64), dtype=torch.float32, device="cpu")
         return (mask.unsqueeze(0),)
@@ -466,6 +549,9 @@ class SaveImagesWithoutOutput:
             },
             "optional": {
                 "addMetadata": ("BOOLEAN", {"default": False, "label_on": "True", "label_off": "False"}),
+                "image_format": (list(image_formats.keys()), {"default": "png", "tooltip": "保存格式，只有png会保存元数据"}),
+                "compress_level": ("INT", {"default": 4, "min": 0, "max": 9, "step": 1, "tooltip": "png压缩等级，越大文件越小，保存越慢"}),
+                "quality": ("INT", {"default": 90, "min": 1, "max": 100, "step": 1, "tooltip": "webp和jpeg的质量"}),
             },
             "hidden": {"prompt": "PROMPT", "extra_pnginfo": "EXTRA_PNGINFO"},
         }
@@ -481,7 +567,8 @@ class SaveImagesWithoutOutput:
     DESCRIPTION = "保存图像到指定目录，不自动创建目标目录（可配置允许），可根据返回的文件路径进行后续操作，此节点为非输出节点，适合批量处理和用于惰性求值的前置节点"
     OUTPUT_NODE = False
 
-    def save_images(self, images, output_dir, filename_prefix="ComfyUI", addMetadata=False, prompt=None, extra_pnginfo=None):
+    def save_images(self, images, output_dir, filename_prefix="ComfyUI", addMetadata=False, image_format="png",
+                    compress_level=None, quality=90, prompt=None, extra_pnginfo=None):
         imageList = list()
         if not isinstance(images, list):
             imageList.append(images)
@@ -492,29 +579,43 @@ class SaveImagesWithoutOutput:
             output_dir = folder_paths.get_output_directory()
 
         output_dir = check_directory(output_dir)
-
-        results = list()
+        if compress_level is None:
+            compress_level = self.compress_level
+
+        metadata = None
+        if not args.disable_metadata and addMetadata and image_format == "png":
+            metadata = PngInfo()
+            if prompt is not None:
+                metadata.add_text("prompt", json.dumps(prompt))
+            if extra_pnginfo is not None:
+                for x in extra_pnginfo:
+                    metadata.add_text(x, json.dumps(extra_pnginfo[x]))
+
+        extension = image_formats[image_format][2]
+        # 先按顺序生成文件路径，再在线程池中并行编码保存。
+        # 生成路径时文件还没有写入，get_save_image_path返回的序号不会增加，需要记录每个文件名已经使用的序号
+        tasks = list()
+        next_counters = dict()
         for (index, images) in enumerate(imageList):
-            for (batch_number, image) in enumerate(images):
-                full_output_folder, filename, counter, subfolder, curr_filename_prefix = folder_paths.get_save_image_path(
-                    filename_prefix, output_dir, image.shape[1], image.shape[0])
-                img = tensor_to_pil(image)
-                metadata = None
-                if not args.disable_metadata and addMetadata:
-                    metadata = PngInfo()
-                    if prompt is not None:
-                        metadata.add_text("prompt", json.dumps(prompt))
-                    if extra_pnginfo is not None:
-                        for x in extra_pnginfo:
-                            metadata.add_text(x, json.dumps(extra_pnginfo[x]))
-
+            if len(images) == 0:
+                continue
+            full_output_folder, filename, counter, subfolder, curr_filename_prefix = folder_paths.get_save_image_path(
+                filename_prefix, output_dir, images[0].shape[1], images[0].shape[0])
+            counter = max(counter, next_counters.get((full_output_folder, filename), 0))
+            for (batch_number, image) in enumerate(tensor_to_uint8(images)):
                 filename_with_batch_num = filename.replace("%batch_num%", str(batch_number))
-                file = f"{filename_with_batch_num}_{counter:05}_.png"
-                image_save_path = os.path.join(full_output_folder, file)
-                img.save(image_save_path, pnginfo=metadata, compress_level=self.compress_level)
-                results.append(image_save_path)
+                file = f"{filename_with_batch_num}_{counter:05}_.{extension}"
+                tasks.append((image, os.path.join(full_output_folder, file)))
                 counter += 1
+            next_counters[(full_output_folder, filename)] = counter
+
+        def save(task):
+            image, image_save_path = task
+            save_image(Image.fromarray(image.squeeze()), image_save_path, image_format=image_format,
+                       compress_level=compress_level, quality=quality, pnginfo=metadata)
+            return image_save_path
 
+        results = encode_in_pool(save, tasks)
         return (results,)
 
 
@@ -537,6 +638,9 @@ class SaveSingleImageWithoutOutput:
             },
             "optional": {
                 "addMetadata": ("BOOLEAN", {"default": False, "label_on": "True", "label_off": "False"}),
+                "image_format": (list(image_formats.keys()), {"default": "png", "tooltip": "保存格式，只有png会保存元数据"}),
+                "compress_level": ("INT", {"default": 4, "min": 0, "max": 9, "step": 1, "tooltip": "png压缩等级，越大文件越小，保存越慢"}),
+                "quality": ("INT", {"default": 90, "min": 1, "max": 100, "step": 1, "tooltip": "webp和jpeg的质量"}),
             },
             "hidden": {"prompt": "PROMPT", "extra_pnginfo": "EXTRA_PNGINFO"},
         }
@@ -551,7 +655,8 @@ class SaveSingleImageWithoutOutput:
     DESCRIPTION = "保存图像到指定目录，可根据返回的文件路径进行后续操作，此节点为非输出节点，适合循环批处理和用于惰性求值的前置节点。只会处理一个"
     OUTPUT_NODE = False
 
-    def save_image(self, image, full_file_name, output_dir, filename_prefix="ComfyUI", addMetadata=False, prompt=None, extra_pnginfo=None):
+    def save_image(self, image, full_file_name, output_dir, filename_prefix="ComfyUI", addMetadata=False, image_format="png",
+                   compress_level=None, quality=90, prompt=None, extra_pnginfo=None):
         imageList = list()
         if not isinstance(image, list):
             imageList.append(image)
@@ -568,7 +673,7 @@ class SaveSingleImageWithoutOutput:
             for (batch_number, image) in enumerate(image):
                 img = tensor_to_pil(image)
                 metadata = None
-                if not args.disable_metadata and addMetadata:
+                if not args.disable_metadata and addMetadata and image_format == "png":
                     metadata = PngInfo()
                     if prompt is not None:
                         metadata.add_text("prompt", json.dumps(prompt))
@@ -591,10 +696,13 @@ class SaveSingleImageWithoutOutput:
                     full_output_folder, filename, counter, subfolder, curr_filename_prefix = folder_paths.get_save_image_path(
                         filename_prefix, output_dir, image.shape[1], image.shape[0])
                     filename_with_batch_num = filename.replace("%batch_num%", str(batch_number))
-                    file = f"{filename_with_batch_num}_{counter:05}_.png"
+                    file = f"{filename_with_batch_num}_{counter:05}_.{image_formats[image_format][2]}"
                     image_save_path = os.path.join(full_output_folder, file)
 
-                img.save(image_save_path, pnginfo=metadata, compress_level=self.compress_level)
+                if compress_level is None:
+                    compress_level = self.compress_level
+                save_image(img, image_save_path, image_format=image_format, compress_level=compress_level,
+                           quality=quality, pnginfo=metadata)
                 return image_save_path,
 
         return (None,)
@@ -632,6 +740,7 @@ NODE_CLASS_MAPPINGS = {
     "ImageToBase64": ImageToBase64,
     # "MaskToBase64": MaskToBase64,
     "Base64ToMask": Base64ToMask,
+    "LoadImageFromBlob": LoadImageFromBlob,
     "ImageToBase64Advanced": ImageToBase64Advanced,
     "MaskToBase64Image": MaskToBase64Image,
     "MaskImageToBase64": MaskImageToBase64,
@@ -651,6 +760,7 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "ImageToBase64": "Image To Base64",
     # "MaskToBase64": "Mask To Base64",
     "Base64ToMask": "Base64 To Mask",
+    "LoadImageFromBlob": "Load Image From Blob",
     "ImageToBase64Advanced": "Image To Base64 (Advanced)",
     "MaskToBase64Image": "Mask To Base64 Image",
     "MaskImageToBase64": "Mask Image To Base64",
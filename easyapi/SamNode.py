@@ -1,13 +1,8 @@
 import torch
-from segment_anything import SamAutomaticMaskGenerator
 import json
-import numpy as np
-from segment_anything.utils.amg import area_from_rle, mask_to_rle_pytorch, rle_to_mask, batched_mask_to_box, \
-    box_xyxy_to_xywh, coco_encode_rle
-from pycocotools import mask as mask_utils
 
 import nodes
-from .util import tensor_to_pil
+from .util import tensor_to_uint8
 
 
 class SamAutoMaskSEGSAdvanced:
@@ -184,6 +179,8 @@ class SamAutoMaskSEGSAdvanced:
                                                          min_mask_region_area,
                                                          output_mode=output_mode)
         else:
+            # segment_anything在第一次执行节点时才导入，未安装时不影响其他节点
+            from segment_anything import SamAutomaticMaskGenerator
             mask_generator = SamAutomaticMaskGenerator(sam_model,
                                                        points_per_side,
                                                        points_per_batch,
@@ -198,8 +195,7 @@ class SamAutoMaskSEGSAdvanced:
                                                        point_grids,
                                                        min_mask_region_area,
                                                        output_mode=output_mode)
-        image_pil = tensor_to_pil(image)
-        image_np = np.array(image_pil)
+        image_np = tensor_to_uint8(image)[0]
         image_np_rgb = image_np[..., :3]
 
         masks = mask_generator.generate(image_np_rgb)
@@ -253,6 +249,8 @@ class MaskToRle:
     CATEGORY = "EasyApi/Detect"
 
     def convert(self, mask, output_mode):
+        from segment_anything.utils.amg import area_from_rle, mask_to_rle_pytorch, batched_mask_to_box, \
+            box_xyxy_to_xywh, coco_encode_rle
         masksRle = []
         b, h, w = mask.shape
         rles = mask_to_rle_pytorch((mask > 0.15).bool())
@@ -308,8 +306,10 @@ class RleToMask:
             list_rle = masks_rle
         for mask_rle in list_rle:
             if rle_mode == "coco_rle":
+                from pycocotools import mask as mask_utils
                 mask_np = mask_utils.decode(mask_rle["segmentation"])
             else:
+                from segment_anything.utils.amg import rle_to_mask
                 mask_np = rle_to_mask(mask_rle["segmentation"])
 
             mask = torch.from_numpy(mask_np).to(torch.float32)
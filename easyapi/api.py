@@ -1,25 +1,25 @@
+import asyncio
+import json
 import os
+import time
 
-import folder_paths
-import nodes
 from server import PromptServer
 from aiohttp import web
 import execution
-from simple_lama_inpainting import SimpleLama
-from .util import image_to_base64, base64_to_image
-from .settings import reset_history_size, get_settings, set_settings
+from .util import image_to_base64, base64_to_image, get_prompt_pool
+from .settings import reset_history_size, get_settings, set_settings, get_setting_value
+from .blobStore import upload_store, result_store, put_blob, read_blob_from_stream, BlobTooLargeError
+from .cache import get_caches
+from . import lamaCleaner, logScript, profiler, promptHistory, promptMemo, promptEvents, promptQueue
+from .promptHistory import trim_history, history_tracker
+from .promptQueue import build_batch, enqueue_batch, cancel_prompts, fair_scheduler, record_from_queue, \
+    QueueFullError, DuplicatePromptError, PRIORITY_OFFSETS
+from .promptMemo import prompt_hash, prompt_memo
+from .promptEvents import prompt_events, record_from_history
+from .mirrorUrlApply import mirror_health
 
 extension_folder = os.path.dirname(os.path.realpath(__file__))
 
-simple_lama = None
-lama_model_dir = os.path.join(folder_paths.models_dir, "lama")
-lama_model_path = os.path.join(lama_model_dir, "big-lama.pt")
-if not os.path.exists(lama_model_path):
-    os.environ['LAMA_MODEL'] = lama_model_path
-    print(f"## lama model not found: {lama_model_path}, pls download from https://github.com/enesmsahin/simple-lama-inpainting/releases/download/v0.1.0/big-lama.pt")
-else:
-    os.environ['LAMA_MODEL'] = lama_model_path
-os.makedirs(lama_model_dir, exist_ok=True)
 
 
 def register_routes():
@@ -29,18 +29,12 @@ def register_routes():
         size = json_data["maxSize"]
         if size is not None:
             promptQueue = PromptServer.instance.prompt_queue
+            maxSize = int(size)
             with promptQueue.mutex:
-                maxSize = int(size)
                 execution.MAXIMUM_HISTORY_SIZE = maxSize
-                history = promptQueue.history
-                end = len(history) - maxSize
-                i = 0
-                for key in list(history.keys()):
-                    if i >= end:
-                        break
-                    history.pop(key)
-                    i = i + 1
-                reset_history_size(maxSize)
+                trim_history(promptQueue.history, maxSize)
+            # 保存配置不需要持有队列的锁
+            reset_history_size(maxSize)
             return web.Response(status=200)
 
         return web.Response(status=400)
@@ -54,6 +48,12 @@ def register_routes():
 
         return web.json_response({"maxSize": maxSize})
 
+    @PromptServer.instance.routes.get("/easyapi/history/stats")
+    async def get_history_stats(request):
+        promptQueue = PromptServer.instance.prompt_queue
+        with promptQueue.mutex:
+            return web.json_response(history_tracker.stats(promptQueue.history))
+
     @PromptServer.instance.routes.post("/easyapi/settings/{id}")
     async def set_setting(request):
         setting_id = request.match_info.get("id", None)
@@ -61,6 +61,8 @@ def register_routes():
             return web.Response(status=400)
         json_body = await request.json()
         set_settings(setting_id, json_body[setting_id])
+        if setting_id == "lama_max_in_flight":
+            await lamaCleaner.lama_limiter.wake()
         return web.Response(status=200)
 
     @PromptServer.instance.routes.get("/easyapi/settings/{id}")
@@ -74,80 +76,412 @@ def register_routes():
 
     @PromptServer.instance.routes.post("/easyapi/prompt")
     async def post_prompt(request):
-        print("got prompt")
-        json_data = await request.json()
+        """
+        与ComfyUI的/prompt相同，请求体的json解析和prompt校验在线程池中执行，不阻塞事件循环。
+        返回和响应头Server-Timing中包含解析和校验的耗时(毫秒)
+        """
+        loop = asyncio.get_running_loop()
+        pool = get_prompt_pool()
+        body = await request.read()
+        start = time.perf_counter()
+        try:
+            json_data = await loop.run_in_executor(pool, json.loads, body)
+        except ValueError as e:
+            return web.json_response({"error": "invalid json: {}".format(e), "node_errors": []}, status=400)
+        parse_ms = (time.perf_counter() - start) * 1000
+        # on_prompt回调可能访问PromptServer的状态，在事件循环中执行
         json_data = PromptServer.instance.trigger_on_prompt(json_data)
         prompt_id = json_data["prompt_id"]
-        print("prompt_id={}".format(json_data["prompt_id"]))
+        print("got prompt, prompt_id={}".format(prompt_id))
+
+        # memoize为true时，相同的prompt直接返回缓存的结果，或者返回队列中相同prompt的prompt_id
+        memo_key = None
+        if "prompt" in json_data and json_data.get("memoize", get_setting_value("prompt_memoize", False)):
+            start = time.perf_counter()
+            memo_key = await loop.run_in_executor(pool, prompt_hash, json_data["prompt"])
+            hash_ms = (time.perf_counter() - start) * 1000
+            memo = prompt_memo.lookup(memo_key, PromptServer.instance.prompt_queue)
+            if memo is not None:
+                return memo_response(memo, {"parse_ms": round(parse_ms, 3), "hash_ms": round(hash_ms, 3)})
 
+        # 没有指定number和front时，按priority(interactive/default/bulk)和client_id公平排队，放入队列时再计算序号
+        priority = json_data.get("priority", "default")
+        if priority not in PRIORITY_OFFSETS:
+            return web.json_response({"error": "unknown priority: {}".format(priority), "node_errors": []},
+                                     status=400)
+        number = None
         if "number" in json_data:
             number = float(json_data['number'])
-        else:
-            number = PromptServer.instance.number
-            if "front" in json_data:
-                if json_data['front']:
-                    number = -number
-
+        elif json_data.get("front"):
+            number = -PromptServer.instance.number
             PromptServer.instance.number += 1
+        else:
+            try:
+                # 校验前先检查一次，排队已满时不需要校验
+                fair_scheduler.check_limit(PromptServer.instance.prompt_queue, priority)
+            except QueueFullError as e:
+                return queue_full_response(e)
 
         if "prompt" in json_data:
             prompt = json_data["prompt"]
-            valid = execution.validate_prompt(prompt)
+            start = time.perf_counter()
+            valid = await loop.run_in_executor(pool, execution.validate_prompt, prompt)
+            validate_ms = (time.perf_counter() - start) * 1000
+            timing = {"parse_ms": round(parse_ms, 3), "validate_ms": round(validate_ms, 3)}
+            headers = {"Server-Timing": "parse;dur={:.3f}, validate;dur={:.3f}".format(parse_ms, validate_ms)}
             extra_data = {}
             if "extra_data" in json_data:
                 extra_data = json_data["extra_data"]
 
             if "client_id" in json_data:
                 extra_data["client_id"] = json_data["client_id"]
+            if memo_key is not None:
+                timing["hash_ms"] = round(hash_ms, 3)
             if valid[0]:
+                if memo_key is not None:
+                    # 校验期间可能已经提交了相同的prompt
+                    memo = prompt_memo.lookup(memo_key, PromptServer.instance.prompt_queue)
+                    if memo is not None:
+                        return memo_response(memo, timing)
+                    prompt_memo.register(memo_key, prompt_id)
                 outputs_to_execute = valid[2]
-                PromptServer.instance.prompt_queue.put((number, prompt_id, prompt, extra_data, outputs_to_execute))
-                response = {"prompt_id": prompt_id, "number": number, "node_errors": valid[3]}
-                return web.json_response(response)
+                prompt_queue = PromptServer.instance.prompt_queue
+                with prompt_queue.mutex:
+                    try:
+                        if number is None:
+                            fair_scheduler.check_limit(prompt_queue, priority)
+                            number = fair_scheduler.assign(PromptServer.instance, priority, json_data.get("client_id"))
+                    except QueueFullError as e:
+                        prompt_memo.forget(prompt_id)
+                        return queue_full_response(e)
+                    prompt_queue.put((number, prompt_id, prompt, extra_data, outputs_to_execute))
+                response = {"prompt_id": prompt_id, "number": number, "node_errors": valid[3], "timing": timing}
+                return web.json_response(response, headers=headers)
             else:
                 print("invalid prompt:", valid[1])
-                return web.json_response({"error": valid[1], "node_errors": valid[3]}, status=400)
+                return web.json_response({"error": valid[1], "node_errors": valid[3], "timing": timing}, status=400,
+                                         headers=headers)
         else:
             return web.json_response({"error": "no prompt", "node_errors": []}, status=400)
 
+    def queue_full_response(error):
+        return web.json_response({"error": str(error), "node_errors": []}, status=429,
+                                 headers={"Retry-After": str(error.retry_after)})
+
+    @PromptServer.instance.routes.get("/easyapi/prompt/queue/status")
+    async def get_prompt_queue_status(request):
+        """
+        每个优先级的排队数量和最近开始执行的prompt的排队时间
+        """
+        return web.json_response(fair_scheduler.status(PromptServer.instance.prompt_queue))
+
+    def memo_response(memo, timing):
+        state, memo_prompt_id, outputs = memo
+        response = {"prompt_id": memo_prompt_id, "number": None, "node_errors": {}, "memo": state, "timing": timing}
+        if state == "hit":
+            response["outputs"] = outputs
+        return web.json_response(response)
+
+    @PromptServer.instance.routes.get("/easyapi/prompt/memo")
+    async def get_prompt_memo(request):
+        return web.json_response(prompt_memo.stats())
+
+    def find_prompt_record(prompt_id):
+        record = prompt_events.get(prompt_id)
+        if record is None:
+            record = record_from_queue(PromptServer.instance, prompt_id) or record_from_history(prompt_id)
+        return record
+
+    @PromptServer.instance.routes.get("/easyapi/prompt/{id}/wait")
+    async def wait_prompt(request):
+        """
+        长轮询单个prompt的状态。不传since时等待执行结束；传since时有序号大于since的事件就返回。
+        超时(timeout秒，默认30，最大300)时返回当前状态
+        """
+        prompt_id = request.match_info["id"]
+        record = find_prompt_record(prompt_id)
+        if record is None:
+            return web.json_response({"error": "prompt not found"}, status=404)
+        try:
+            timeout = min(300.0, max(0.0, float(request.query.get("timeout", 30))))
+            since = request.query.get("since")
+            since = int(since) if since is not None else None
+        except ValueError:
+            return web.json_response({"error": "invalid timeout or since"}, status=400)
+        await prompt_events.wait(record, since or 0, timeout, until_finished=since is None)
+        return web.json_response(prompt_events.snapshot(record, since))
+
+    @PromptServer.instance.routes.get("/easyapi/prompt/{id}/events")
+    async def prompt_event_stream(request):
+        """
+        以server-sent events推送单个prompt的事件，断线重连时按Last-Event-ID继续推送，执行结束时推送done事件(包含输出)后关闭
+        """
+        prompt_id = request.match_info["id"]
+        record = find_prompt_record(prompt_id)
+        if record is None:
+            return web.json_response({"error": "prompt not found"}, status=404)
+        try:
+            seq = int(request.headers.get("Last-Event-ID", request.query.get("since", 0)))
+        except ValueError:
+            seq = 0
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        while True:
+            snapshot = prompt_events.snapshot(record, seq)
+            events = snapshot.pop("events")
+            for event in events:
+                seq = event["id"]
+                data = snapshot if event["event"] == "done" else event["data"]
+                await response.write("id: {}\nevent: {}\ndata: {}\n\n".format(
+                    seq, event["event"], json.dumps(data)).encode("utf-8"))
+            if "outputs" in snapshot:
+                if snapshot["seq"] == 0:
+                    # 从历史记录恢复的prompt没有事件
+                    await response.write("event: done\ndata: {}\n\n".format(json.dumps(snapshot)).encode("utf-8"))
+                break
+            if not await prompt_events.wait(record, seq, 15):
+                # 保持连接
+                await response.write(b": keep-alive\n\n")
+        await response.write_eof()
+        return response
+
+    @PromptServer.instance.routes.post("/easyapi/prompt/batch")
+    async def post_prompt_batch(request):
+        """
+        批量提交相同workflow的prompt，请求体：
+        {"prompt": 模板, "items": [{"inputs": {节点id: {输入名: 值}}, "prompt_id": 可选, "extra_data": 可选}],
+         "client_id": 可选, "extra_data": 可选, "front": 可选, "priority": 可选}
+        模板只校验一次，每一项只允许覆盖非连接线的输入(按节点的INPUT_TYPES检查类型和范围)，
+        全部通过后一次性放入队列，任意一项出错时都不放入队列
+        """
+        loop = asyncio.get_running_loop()
+        pool = get_prompt_pool()
+        body = await request.read()
+        start = time.perf_counter()
+        try:
+            json_data = await loop.run_in_executor(pool, json.loads, body)
+        except ValueError as e:
+            return web.json_response({"error": "invalid json: {}".format(e), "node_errors": []}, status=400)
+        parse_ms = (time.perf_counter() - start) * 1000
+        json_data = PromptServer.instance.trigger_on_prompt(json_data)
+        if "prompt" not in json_data:
+            return web.json_response({"error": "no prompt", "node_errors": []}, status=400)
+        items = json_data.get("items")
+        if not isinstance(items, list) or len(items) == 0:
+            return web.json_response({"error": "no items", "node_errors": []}, status=400)
+        max_size = int(get_setting_value("prompt_batch_max_size", 1000))
+        if len(items) > max_size:
+            return web.json_response({"error": "too many items, max {}".format(max_size), "node_errors": []},
+                                     status=400)
+        priority = json_data.get("priority", "default")
+        if priority not in PRIORITY_OFFSETS:
+            return web.json_response({"error": "unknown priority: {}".format(priority), "node_errors": []},
+                                     status=400)
+        template = json_data["prompt"]
+        print("got prompt batch, items={}".format(len(items)))
+
+        start = time.perf_counter()
+        valid = await loop.run_in_executor(pool, execution.validate_prompt, template)
+        validate_ms = (time.perf_counter() - start) * 1000
+        if not valid[0]:
+            print("invalid prompt:", valid[1])
+            return web.json_response({"error": valid[1], "node_errors": valid[3]}, status=400)
+        start = time.perf_counter()
+        batch, item_errors = await loop.run_in_executor(pool, build_batch, template, items,
+                                                        json_data.get("extra_data"), json_data.get("client_id"))
+        build_ms = (time.perf_counter() - start) * 1000
+        timing = {"parse_ms": round(parse_ms, 3), "validate_ms": round(validate_ms, 3), "build_ms": round(build_ms, 3)}
+        if len(item_errors) > 0:
+            return web.json_response({"error": "invalid items", "item_errors": item_errors, "node_errors": {},
+                                      "timing": timing}, status=400)
+        try:
+            numbers = enqueue_batch(PromptServer.instance, batch, valid[2], bool(json_data.get("front")), priority,
+                                    json_data.get("client_id"))
+        except QueueFullError as e:
+            return queue_full_response(e)
+        except DuplicatePromptError as e:
+            item_errors = {index: "prompt_id already exists: {}".format(prompt_id)
+                           for index, (prompt_id, _, _) in enumerate(batch) if prompt_id in e.prompt_ids}
+            return web.json_response({"error": "invalid items", "item_errors": item_errors, "node_errors": {},
+                                      "timing": timing}, status=400)
+        return web.json_response({"prompt_ids": [prompt_id for prompt_id, _, _ in batch], "numbers": numbers,
+                                  "node_errors": valid[3], "timing": timing})
+
+    @PromptServer.instance.routes.post("/easyapi/blob")
+    async def upload_blob(request):
+        """
+        上传图片原始数据，支持multipart/form-data(可多个文件)和直接以请求体上传二进制，
+        返回的id用于LoadImageFromBlob节点，避免图片经过base64编码和json解析
+        """
+        # 按上传缓存的容量限制请求大小，超过时不再读取剩余的数据
+        max_size = upload_store.max_bytes
+        if request.content_length is not None and request.content_length > max_size:
+            return web.json_response({"error": "blob too large"}, status=413)
+        blobs = []
+        size = 0
+        try:
+            if request.content_type.startswith("multipart/"):
+                reader = await request.multipart()
+                async for part in reader:
+                    if part.filename is None:
+                        continue
+                    blob_id, data = await read_blob_from_stream(part, max_size=max_size - size)
+                    size += len(data)
+                    blobs.append((blob_id, data, part.headers.get("Content-Type")))
+            else:
+                blob_id, data = await read_blob_from_stream(request.content, max_size=max_size)
+                if len(data) > 0:
+                    blobs.append((blob_id, data, request.content_type))
+        except BlobTooLargeError:
+            return web.json_response({"error": "blob too large"}, status=413)
+
+        if len(blobs) == 0:
+            return web.json_response({"error": "no data"}, status=400)
+
+        ids = []
+        for blob_id, data, content_type in blobs:
+            if put_blob(upload_store, data, content_type, blob_id=blob_id) is None:
+                return web.json_response({"error": "blob too large"}, status=413)
+            ids.append(blob_id)
+        return web.json_response({"ids": ids})
+
+    @PromptServer.instance.routes.delete("/easyapi/blob/{id}")
+    async def delete_blob(request):
+        blob_id = request.match_info.get("id", None)
+        if upload_store.pop(blob_id) is None:
+            return web.Response(status=404)
+        return web.Response(status=200)
+
+    @PromptServer.instance.routes.get("/easyapi/result/{id}")
+    async def get_result_blob(request):
+        blob_id = request.match_info.get("id", None)
+        blob = result_store.get(blob_id)
+        if blob is None:
+            return web.Response(status=404)
+        data, content_type = blob
+        return web.Response(body=data, content_type=content_type)
+
+    @PromptServer.instance.routes.get("/easyapi/cache")
+    async def get_cache_stats(request):
+        return web.json_response({name: cache.stats() for name, cache in get_caches().items()})
+
+    @PromptServer.instance.routes.get("/easyapi/cache/{name}")
+    async def get_cache_stat(request):
+        cache = get_caches().get(request.match_info.get("name", None))
+        if cache is None:
+            return web.Response(status=404)
+        return web.json_response(cache.stats())
+
+    @PromptServer.instance.routes.post("/easyapi/cache/{name}/clear")
+    async def clear_cache(request):
+        cache = get_caches().get(request.match_info.get("name", None))
+        if cache is None:
+            return web.Response(status=404)
+        cache.clear()
+        return web.Response(status=200)
+
     @PromptServer.instance.routes.post("/easyapi/interrupt")
     async def post_interrupt(request):
         json_data = await request.json()
         prompt_id = json_data["prompt_id"]
-        current_queue = PromptServer.instance.prompt_queue.get_current_queue()
-        queue_running = current_queue[0]
-        if queue_running is not None and len(queue_running) > 0:
-            if len(queue_running[0]) > 0 and queue_running[0][1] == prompt_id:
-                nodes.interrupt_processing()
-
-        delete_func = lambda a: a[1] == prompt_id
-        PromptServer.instance.prompt_queue.delete_queue_item(delete_func)
+        cancel_prompts(PromptServer.instance, [prompt_id])
         return web.Response(status=200)
 
+    @PromptServer.instance.routes.post("/easyapi/prompt/cancel")
+    async def post_cancel_prompts(request):
+        """
+        批量取消prompt，请求体：{"prompt_ids": [...], "client_id": 可选}，指定client_id时取消该client的所有prompt。
+        返回正在执行(已发送中断)、排队中(已删除)、已经执行完成和不存在的prompt_id及数量
+        """
+        json_data = await request.json()
+        prompt_ids = json_data.get("prompt_ids") or []
+        client_id = json_data.get("client_id")
+        if not isinstance(prompt_ids, list) or (len(prompt_ids) == 0 and client_id is None):
+            return web.json_response({"error": "no prompt_ids or client_id"}, status=400)
+        result = cancel_prompts(PromptServer.instance, prompt_ids, client_id)
+        result["counts"] = {key: len(value) for key, value in result.items()}
+        return web.json_response(result)
+
     @PromptServer.instance.routes.post("/easyapi/lama_cleaner")
     async def lama_cleaner(request):
-        json_data = await request.json()
-        image = json_data["image"]
-        mask = json_data["mask"]
-        if image is None or mask is None:
-            return web.json_response({"error": "missing required params"}, status=400)
+        limiter = lamaCleaner.lama_limiter
+        start_time = time.monotonic()
+        # 先占位再读取请求体，被拒绝的请求不占用内存
+        if not await limiter.acquire():
+            return web.json_response({"error": "too many requests"}, status=429,
+                                     headers={"Retry-After": str(limiter.retry_after())})
+        try:
+            return await process_lama_cleaner(request)
+        finally:
+            await limiter.release(start_time)
 
-        global simple_lama
-        if simple_lama is None:
-            simple_lama = SimpleLama()
+    @PromptServer.instance.routes.get("/easyapi/metrics")
+    async def get_metrics(request):
+        if request.rel_url.query.get("format") == "prometheus":
+            return web.Response(text=profiler.metrics_prometheus(),
+                                headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+        return web.json_response(profiler.metrics_json())
 
-        image = base64_to_image(image)
-        mask = base64_to_image(mask)
-        mask = mask.convert('L')
+    @PromptServer.instance.routes.post("/easyapi/metrics/reset")
+    async def reset_metrics(request):
+        profiler.reset()
+        return web.Response(status=200)
+
+    @PromptServer.instance.routes.get("/easyapi/log/status")
+    async def log_status(request):
+        if logScript.log_sink is None:
+            return web.json_response({"async": False})
+        return web.json_response(dict(logScript.log_sink.stats(), **{"async": True}))
+
+    @PromptServer.instance.routes.get("/easyapi/mirrors/status")
+    async def mirrors_status(request):
+        if request.rel_url.query.get("probe") in ("1", "true"):
+            # 在线程池中立即探测一次，返回最新结果
+            await asyncio.get_running_loop().run_in_executor(None, mirror_health.probe_all)
+        return web.json_response(mirror_health.status())
 
-        res = simple_lama(image, mask)
+    @PromptServer.instance.routes.get("/easyapi/lama_cleaner/status")
+    async def lama_cleaner_status(request):
+        return web.json_response(lamaCleaner.lama_limiter.status())
 
-        encoded_image = image_to_base64(res)
+    async def process_lama_cleaner(request):
+        loop = asyncio.get_running_loop()
+        body = await request.read()
+
+        def decode():
+            json_data = json.loads(body)
+            image = json_data.get("image")
+            mask = json_data.get("mask")
+            if image is None or mask is None:
+                return None, None
+            return base64_to_image(image), base64_to_image(mask).convert('L')
+
+        # json解析、base64解码、推理和编码都不在事件循环中执行
+        image, mask = await loop.run_in_executor(None, decode)
+        if image is None or mask is None:
+            return web.json_response({"error": "missing required params"}, status=400)
+
+        res = await asyncio.wrap_future(lamaCleaner.lama_worker.submit(image, mask))
+
+        encoded_image = await loop.run_in_executor(None, image_to_base64, res)
 
         response = {"base64Image": encoded_image}
         return web.json_response(response, status=200)
 
 
+_initialized = False
+
+
 def init():
+    # __init__.py和loadCustomNodes都会调用init，只初始化一次
+    global _initialized
+    if _initialized:
+        return
+    _initialized = True
     reset_history_size(isStart=True)
     register_routes()
+    lamaCleaner.init()
+    promptHistory.init()
+    promptMemo.init()
+    promptEvents.init()
+    promptQueue.init()
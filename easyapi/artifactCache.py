@@ -0,0 +1,417 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+from . import downloader
+from .cache import register_cache
+from .settings import get_setting_value
+from .urlCache import write_file_atomic
+
+extension_folder = os.path.dirname(os.path.realpath(__file__))
+
+# linux的FICLONE ioctl，btrfs/xfs等文件系统支持写时复制
+FICLONE = 0x40049409
+
+
+def link_file(src, dst):
+    """
+    生成src的独立副本，依次尝试reflink、硬链接、复制
+    Returns: 使用的方式
+    """
+    try:
+        import fcntl
+        with open(src, "rb") as fs, open(dst, "wb") as fd:
+            fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+        return "reflink"
+    except (ImportError, OSError):
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        pass
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+def _dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+class ArtifactCache:
+    """
+    模型文件和git仓库的共享缓存，多个ComfyUI实例可以配置相同的目录(artifact_cache_dir)。
+    objects目录下的文件以内容的sha256命名，index目录下每个url对应一个记录文件，保存ETag/Last-Modified和文件的sha256，
+    再次下载时发送条件请求，服务端返回304时使用缓存的文件；git目录下保存仓库的镜像(clone --mirror)，
+    再次克隆时先更新镜像，再从本地镜像克隆(对象文件使用硬链接)。
+    记录按原始地址(镜像替换前)保存，不同镜像共享同一份缓存，所以保存时校验文件大小和sha256(服务端提供时)，
+    不一致的内容不缓存，读取时检查文件大小。
+    超过容量上限(artifact_cache_max_size，MB)时按最近访问时间淘汰
+    """
+
+    def __init__(self, name):
+        self.name = name
+        # 缓存文件的访问顺序，key是相对cache_dir的路径，值是大小
+        self._entries = None
+        self._cache_dir = None
+        self._size = 0
+        self._lock = threading.RLock()
+        self._git_locks = {}
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.stores = 0
+        # 校验失败不缓存的次数
+        self.rejected = 0
+        self.git_hits = 0
+        self.git_misses = 0
+        self.evictions = 0
+        register_cache(name, self)
+
+    @property
+    def enabled(self):
+        return bool(get_setting_value("artifact_cache_enabled", False))
+
+    @property
+    def cache_dir(self):
+        return get_setting_value("artifact_cache_dir", os.path.join(extension_folder, "cache", "artifact"))
+
+    @property
+    def max_bytes(self):
+        return int(float(get_setting_value("artifact_cache_max_size", 10240)) * 1024 * 1024)
+
+    @property
+    def min_bytes(self):
+        return int(float(get_setting_value("artifact_cache_min_size", 1)) * 1024 * 1024)
+
+    def _path(self, *names):
+        return os.path.join(self.cache_dir, *names)
+
+    def _load(self):
+        """
+        扫描缓存目录，按修改时间(即最近访问时间)恢复访问顺序，缓存目录变化时重新扫描
+        """
+        cache_dir = self.cache_dir
+        if self._entries is not None and self._cache_dir == cache_dir:
+            return
+        for name in ("objects", "index", "git", "tmp"):
+            os.makedirs(self._path(name), exist_ok=True)
+        entries = []
+        for entry in os.scandir(self._path("objects")):
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, "objects/" + entry.name, stat.st_size))
+        for entry in os.scandir(self._path("git")):
+            if entry.is_dir() and entry.name.endswith(".git"):
+                entries.append((entry.stat().st_mtime, "git/" + entry.name, _dir_size(entry.path)))
+        # 清理异常退出时残留的临时文件，最近的临时文件可能正在被其他实例使用
+        for entry in os.scandir(self._path("tmp")):
+            try:
+                if time.time() - entry.stat().st_mtime < 86400:
+                    continue
+                if entry.is_dir():
+                    shutil.rmtree(entry.path)
+                else:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+        entries.sort()
+        self._entries = OrderedDict((key, size) for _, key, size in entries)
+        self._size = sum(size for _, _, size in entries)
+        self._cache_dir = cache_dir
+
+    def _touch(self, key, size=None):
+        path = self._path(*key.split("/"))
+        now = time.time()
+        try:
+            os.utime(path, (now, now))
+        except OSError:
+            pass
+        with self._lock:
+            if size is not None:
+                self._size += size - self._entries.get(key, 0)
+                self._entries[key] = size
+            if key in self._entries:
+                self._entries.move_to_end(key)
+
+    def _evict(self):
+        max_bytes = self.max_bytes
+        removed = []
+        with self._lock:
+            while self._size > max_bytes and len(self._entries) > 1:
+                key, size = self._entries.popitem(last=False)
+                self._size -= size
+                self.evictions += 1
+                removed.append(key)
+        # 记录文件指向的文件不存在时当作未缓存处理
+        for key in removed:
+            path = self._path(*key.split("/"))
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _index_path(self, url):
+        return self._path("index", hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def lookup(self, url):
+        """
+        Returns: url对应的缓存记录，没有缓存或文件已被淘汰时返回None
+        """
+        with self._lock:
+            self._load()
+        try:
+            with open(self._index_path(url), "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if record.get("url") != url:
+            return None
+        try:
+            # 文件被截断或替换时不使用
+            if os.path.getsize(self._path("objects", record["digest"])) != record["size"]:
+                return None
+        except OSError:
+            return None
+        return record
+
+    @staticmethod
+    def conditional_headers(record):
+        headers = {}
+        if record.get("etag"):
+            headers["If-None-Match"] = record["etag"]
+        if record.get("last_modified"):
+            headers["If-Modified-Since"] = record["last_modified"]
+        return headers
+
+    def request_cacheable(self, method, request_headers=None):
+        """
+        只处理GET请求，请求本身带Range或条件请求头时(调用方自己在续传或校验)不使用缓存
+        """
+        if not self.enabled or str(method).upper() != "GET":
+            return False
+        if request_headers and any(key.lower() in ("range", "if-none-match", "if-modified-since")
+                                   for key in request_headers):
+            return False
+        return True
+
+    def cacheable(self, status, headers):
+        """
+        只缓存带校验信息(ETag/Last-Modified)、未压缩、大小超过artifact_cache_min_size(MB，默认1)的完整响应
+        """
+        if status != 200:
+            return False
+        if not (headers.get("ETag") or headers.get("Last-Modified")):
+            return False
+        if headers.get("Content-Encoding", "identity").lower() != "identity":
+            return False
+        try:
+            return int(headers.get("Content-Length", "-1")) >= self.min_bytes
+        except ValueError:
+            return False
+
+    @staticmethod
+    def record_headers(record, headers):
+        """
+        命中缓存时返回的响应头，headers是空的响应头对象
+        """
+        headers["Content-Length"] = str(record["size"])
+        for key, name in (("content_type", "Content-Type"), ("etag", "ETag"), ("last_modified", "Last-Modified")):
+            if record.get(key):
+                headers[name] = record[key]
+        return headers
+
+    def _materialize(self, digest):
+        dst = self._path("tmp", "{}.{}.{}".format(digest, threading.get_ident(), time.monotonic_ns()))
+        link_file(self._path("objects", digest), dst)
+        return dst
+
+    def materialize(self, record, revalidated=False):
+        """
+        命中缓存时生成缓存文件的独立副本(reflink/硬链接)，读取期间文件被淘汰也不受影响
+        Returns: 副本路径
+        """
+        dst = self._materialize(record["digest"])
+        self._touch("objects/" + record["digest"])
+        self.hits += 1
+        if revalidated:
+            self.revalidated += 1
+        return dst
+
+    @staticmethod
+    def verify(headers, digest, size):
+        """
+        按Content-Length和sha256(ETag/X-Linked-Etag是sha256时)校验下载内容
+        Returns: 不一致时返回错误信息
+        """
+        expected = downloader.expected_sha256(headers)
+        if expected is not None and expected != digest:
+            return "sha256 mismatch, expected {}, got {}".format(expected, digest)
+        try:
+            length = int(headers.get("Content-Length", size))
+        except ValueError:
+            return None
+        if length != size:
+            return "size mismatch, expected {}, got {}".format(length, size)
+        return None
+
+    def store(self, url, chunks, headers, src_path=None, materialize=True, source=None):
+        """
+        保存下载内容，chunks是内容的分块迭代器；已经下载到本地文件时传src_path，文件会被移动到缓存目录。
+        url是原始地址，source是实际下载的地址(可能是镜像站)，内容校验失败时不缓存
+        Returns: 缓存文件的独立副本路径(校验失败时是下载的文件本身)，materialize为False时返回None
+        """
+        with self._lock:
+            self._load()
+        tmp_path = self._path("tmp", "{}.{}.download".format(threading.get_ident(), time.monotonic_ns()))
+        sha = hashlib.sha256()
+        size = 0
+        if src_path is not None:
+            with open(src_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    sha.update(chunk)
+                    size += len(chunk)
+            try:
+                os.replace(src_path, tmp_path)
+            except OSError:
+                shutil.copyfile(src_path, tmp_path)
+        else:
+            with open(tmp_path, "wb") as f:
+                for chunk in chunks:
+                    sha.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+        digest = sha.hexdigest()
+        error = self.verify(headers, digest, size)
+        if error is not None:
+            print("[easyapi] not caching {} from {}, {}".format(url, source or url, error))
+            self.misses += 1
+            self.rejected += 1
+            if materialize:
+                return tmp_path
+            os.remove(tmp_path)
+            return None
+        key = "objects/" + digest
+        os.replace(tmp_path, self._path("objects", digest))
+        record = {"url": url, "source": source or url, "digest": digest, "size": size, "etag": headers.get("ETag"),
+                  "last_modified": headers.get("Last-Modified"), "content_type": headers.get("Content-Type"),
+                  "time": time.time()}
+        write_file_atomic(self._index_path(url), json.dumps(record).encode("utf-8"))
+        self.misses += 1
+        self.stores += 1
+        self._touch(key, size)
+        dst = self._materialize(digest) if materialize else None
+        self._evict()
+        return dst
+
+    def git_mirror(self, key_url, fetch_url):
+        """
+        更新(不存在时创建)仓库镜像，fetch_url是实际下载的地址(可能是镜像站)
+        Returns: 本地镜像路径
+        """
+        import git
+        with self._lock:
+            self._load()
+            name = hashlib.sha256(key_url.encode("utf-8")).hexdigest() + ".git"
+            lock = self._git_locks.setdefault(name, threading.Lock())
+        key = "git/" + name
+        path = self._path("git", name)
+        with lock:
+            if os.path.isdir(path):
+                git.Git().execute(["git", "--git-dir", path, "fetch", "--prune", fetch_url,
+                                   "+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"])
+                self.git_hits += 1
+            else:
+                tmp_path = self._path("tmp", "{}.{}".format(name, time.monotonic_ns()))
+                try:
+                    git.Git().clone("--mirror", fetch_url, tmp_path)
+                    os.replace(tmp_path, path)
+                finally:
+                    shutil.rmtree(tmp_path, ignore_errors=True)
+                self.git_misses += 1
+        self._touch(key, _dir_size(path))
+        self._evict()
+        return path
+
+    def clear(self):
+        with self._lock:
+            self._load()
+            self._entries.clear()
+            self._size = 0
+            for name in ("objects", "index", "git"):
+                shutil.rmtree(self._path(name), ignore_errors=True)
+                os.makedirs(self._path(name), exist_ok=True)
+
+    def stats(self):
+        with self._lock:
+            self._load()
+            return {
+                "entries": len(self._entries),
+                "size": self._size,
+                "max_size": self.max_bytes,
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "misses": self.misses,
+                "stores": self.stores,
+                "rejected": self.rejected,
+                "git_hits": self.git_hits,
+                "git_misses": self.git_misses,
+                "evictions": self.evictions,
+            }
+
+
+artifact_cache = ArtifactCache("artifact")
+
+
+def store_requests_response(url, response):
+    """
+    保存requests的响应到共享缓存
+    Returns: 读取缓存文件的响应
+    """
+    raw = response.raw
+    if isinstance(raw, downloader.DownloadedFile):
+        # 分段下载完成的文件直接移动到缓存目录
+        path = artifact_cache.store(url, None, response.headers, src_path=raw.path, source=response.url)
+        raw.delete = False
+        raw.close()
+    elif response._content_consumed:
+        # stream=False时内容已经读取到内存
+        artifact_cache.store(url, [response.content], response.headers, materialize=False, source=response.url)
+        return response
+    else:
+        path = artifact_cache.store(url, response.iter_content(1024 * 1024), response.headers, source=response.url)
+        response.close()
+    return downloader.requests_file_response(response, path)
+
+
+def store_urllib_response(url, response):
+    """
+    保存urllib的响应到共享缓存
+    Returns: 读取缓存文件的响应
+    """
+    fp = getattr(response, "fp", None)
+    if isinstance(fp, downloader.DownloadedFile):
+        path = artifact_cache.store(url, None, response.headers, src_path=fp.path, source=response.geturl())
+        fp.delete = False
+    else:
+        path = artifact_cache.store(url, iter(lambda: response.read(1024 * 1024), b""), response.headers,
+                                    source=response.geturl())
+    response.close()
+    return downloader.urllib_file_response(response.headers, response.geturl(), path)
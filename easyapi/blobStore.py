@@ -0,0 +1,56 @@
+import hashlib
+import io
+
+from PIL import Image
+
+from .cache import LRUCache
+
+# 上传的原始图片数据，值为(bytes, content_type)
+upload_store = LRUCache("upload_blob", "upload_blob_max_size", 1024, sizeof=lambda v: len(v[0]))
+# 节点输出的编码后图片数据，通过/easyapi/result/{id}获取
+result_store = LRUCache("result_blob", "result_blob_max_size", 1024, sizeof=lambda v: len(v[0]))
+
+
+def put_blob(store, data, content_type=None, blob_id=None):
+    """
+    保存二进制数据，id是内容的sha256，相同内容只保存一份
+    Returns: blob id，超过容量上限时返回None
+    """
+    if blob_id is None:
+        blob_id = hashlib.sha256(data).hexdigest()
+    if not store.put(blob_id, (data, content_type or "application/octet-stream")):
+        return None
+    return blob_id
+
+
+class BlobTooLargeError(ValueError):
+    pass
+
+
+async def read_blob_from_stream(stream, chunk_size=1024 * 1024, max_size=None):
+    """
+    分块读取aiohttp的请求体(StreamReader)或multipart分段(BodyPartReader)，边读边计算sha256，避免额外的拷贝。
+    直接读取请求体不受aiohttp的client_max_size限制，超过max_size(字节)时立即抛出BlobTooLargeError，不继续读取
+    Returns: (blob id, bytearray)
+    """
+    read = stream.read_chunk if hasattr(stream, "read_chunk") else stream.read
+    sha = hashlib.sha256()
+    data = bytearray()
+    while True:
+        chunk = await read(chunk_size)
+        if not chunk:
+            break
+        if max_size is not None and len(data) + len(chunk) > max_size:
+            raise BlobTooLargeError("blob too large, max {} bytes".format(max_size))
+        sha.update(chunk)
+        data.extend(chunk)
+    return sha.hexdigest(), data
+
+
+def read_image_from_blob(blob_id, store=upload_store):
+    blob = store.get(blob_id)
+    if blob is None:
+        raise FileNotFoundError(f"blob not found: {blob_id}")
+    img = Image.open(io.BytesIO(blob[0]))
+    img.load()
+    return img
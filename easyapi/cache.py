@@ -0,0 +1,116 @@
+import threading
+from collections import OrderedDict
+
+from .settings import get_setting_value
+
+# 已创建的缓存，key是缓存名称
+_caches = {}
+
+
+class LRUCache:
+    """
+    按字节数限制容量的LRU缓存，线程安全。
+    容量上限从配置文件中读取(单位MB)，修改配置后下一次写入时生效。
+    """
+
+    def __init__(self, name, max_size_key=None, default_max_mb=256, sizeof=len):
+        self.name = name
+        self.max_size_key = max_size_key
+        self.default_max_mb = default_max_mb
+        self.sizeof = sizeof
+        self._data = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        register_cache(name, self)
+
+    @property
+    def max_bytes(self):
+        max_mb = self.default_max_mb
+        if self.max_size_key is not None:
+            max_mb = get_setting_value(self.max_size_key, max_mb)
+        return int(float(max_mb) * 1024 * 1024)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        """
+        Returns: 是否写入成功，单个值超过容量上限时不缓存
+        """
+        size = self.sizeof(value)
+        max_bytes = self.max_bytes
+        if size > max_bytes:
+            return False
+        with self._lock:
+            if key in self._data:
+                self._size -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self._size += size
+            while self._size > max_bytes and len(self._data) > 1:
+                _, (_, old_size) = self._data.popitem(last=False)
+                self._size -= old_size
+                self.evictions += 1
+        return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                value, size = self._data.pop(key)
+                self._size -= size
+                return value
+            return default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "entries": len(self._data),
+            "size": self._size,
+            "max_size": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def sizeof_tensors(value):
+    """
+    计算张量(或张量的元组/列表/字典)占用的字节数
+    """
+    if isinstance(value, (tuple, list)):
+        return sum(sizeof_tensors(v) for v in value)
+    if isinstance(value, dict):
+        return sum(sizeof_tensors(v) for v in value.values())
+    if hasattr(value, "element_size"):
+        return value.element_size() * value.nelement()
+    return 0
+
+
+def register_cache(name, cache):
+    """
+    注册缓存，注册对象需实现stats()和clear()
+    """
+    _caches[name] = cache
+
+
+def get_caches():
+    return _caches
@@ -0,0 +1,346 @@
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .settings import get_setting_value
+
+extension_folder = os.path.dirname(os.path.realpath(__file__))
+
+_sha256_pattern = re.compile(r'^(W/)?"?([0-9a-fA-F]{64})"?$')
+# 同一个url同时只有一个下载任务写文件
+_download_locks = {}
+_download_locks_lock = threading.Lock()
+
+
+def accelerate_enabled():
+    return bool(get_setting_value("mirror_download_accelerate", False))
+
+
+def min_size():
+    return int(float(get_setting_value("mirror_download_min_size", 64)) * 1024 * 1024)
+
+
+def download_dir():
+    return get_setting_value("mirror_download_dir", os.path.join(extension_folder, "cache", "download"))
+
+
+def should_accelerate(status, headers, request_headers=None):
+    """
+    判断响应是否可以分段并发下载：200、支持bytes分段、未压缩、大小超过mirror_download_min_size(MB，默认64)，
+    请求本身带Range头时(调用方自己在续传)不处理
+    """
+    if status != 200:
+        return False
+    if request_headers and any(key.lower() == "range" for key in request_headers):
+        return False
+    if headers.get("Accept-Ranges", "").lower() != "bytes":
+        return False
+    if headers.get("Content-Encoding", "identity").lower() != "identity":
+        return False
+    try:
+        size = int(headers.get("Content-Length", "-1"))
+    except ValueError:
+        return False
+    return size >= min_size()
+
+
+def expected_sha256(headers):
+    """
+    huggingface等服务返回的ETag(或X-Linked-Etag)是文件的sha256，有则用来校验
+    """
+    for key in ("X-Linked-Etag", "ETag"):
+        value = headers.get(key)
+        if value:
+            match = _sha256_pattern.match(value.strip())
+            if match:
+                return match.group(2).lower()
+    return None
+
+
+class DownloadedFile(io.FileIO):
+    """
+    下载完成的文件，作为requests.Response.raw或urllib响应的fp使用，关闭后删除文件
+    """
+
+    def __init__(self, path, delete=True):
+        super().__init__(path, "rb")
+        self.path = path
+        self.delete = delete
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        if self.delete:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    # requests.Response.close()会调用raw.release_conn()
+    def release_conn(self):
+        self.close()
+
+
+class RangeDownloader:
+    """
+    分段并发下载到预分配的文件中，每完成一段写入一次进度文件(.parts.json)，中断后再次下载相同url时只下载未完成的分段。
+    并发连接数通过配置项mirror_download_connections设置(默认8)，分段大小mirror_download_part_size(MB，默认16)
+    """
+
+    RETRIES = 3
+
+    def __init__(self, url, size, get_range, sha256=None, validator=None):
+        """
+        Args:
+            get_range: get_range(start, end)，返回[start, end]范围内容的分块迭代器
+            validator: ETag或Last-Modified，与进度文件中记录的不一致时重新下载
+        """
+        self.url = url
+        self.size = size
+        self.get_range = get_range
+        self.sha256 = sha256
+        self.validator = validator
+        self.connections = max(1, int(get_setting_value("mirror_download_connections", 8)))
+        self.part_size = max(1024 * 1024, int(float(get_setting_value("mirror_download_part_size", 16)) * 1024 * 1024))
+        name = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        self.path = os.path.join(download_dir(), name)
+        self.part_path = self.path + ".part"
+        self.state_path = self.path + ".parts.json"
+        self._lock = threading.Lock()
+        self._done = set()
+
+    def _parts(self):
+        return [(start, min(start + self.part_size, self.size) - 1) for start in range(0, self.size, self.part_size)]
+
+    def _load_state(self):
+        """
+        读取进度文件，文件大小、分段大小或校验信息变化时从头下载
+        """
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        if (state.get("url") != self.url or state.get("size") != self.size or state.get("part_size") != self.part_size
+                or state.get("validator") != self.validator or not os.path.exists(self.part_path)
+                or os.path.getsize(self.part_path) != self.size):
+            return set()
+        return set(state.get("done", []))
+
+    def _save_state(self):
+        state = {"url": self.url, "size": self.size, "part_size": self.part_size, "validator": self.validator,
+                 "done": sorted(self._done)}
+        tmp_path = "{}.{}.tmp".format(self.state_path, threading.get_ident())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _download_part(self, index, start, end):
+        error = None
+        for _ in range(self.RETRIES):
+            try:
+                with open(self.part_path, "r+b") as f:
+                    f.seek(start)
+                    written = 0
+                    for chunk in self.get_range(start, end):
+                        f.write(chunk)
+                        written += len(chunk)
+                if written != end - start + 1:
+                    raise IOError("range {}-{} incomplete, got {} bytes".format(start, end, written))
+                with self._lock:
+                    self._done.add(index)
+                    self._save_state()
+                return
+            except Exception as e:
+                error = e
+        raise error
+
+    def download(self):
+        """
+        Returns: 下载完成的文件路径
+        """
+        with _download_locks_lock:
+            lock = _download_locks.setdefault(self.path, threading.Lock())
+        with lock:
+            return self._download()
+
+    def _download(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._done = self._load_state()
+        if len(self._done) == 0:
+            with open(self.part_path, "wb") as f:
+                f.truncate(self.size)
+            self._save_state()
+        else:
+            print("[easyapi] resume download {}, {} parts done".format(self.url, len(self._done)))
+
+        parts = [(i, start, end) for i, (start, end) in enumerate(self._parts()) if i not in self._done]
+        if len(parts) > 0:
+            with ThreadPoolExecutor(max_workers=min(self.connections, len(parts)),
+                                    thread_name_prefix="easyapi_download") as pool:
+                futures = [pool.submit(self._download_part, *part) for part in parts]
+                for future in futures:
+                    future.result()
+        self.verify()
+        os.replace(self.part_path, self.path)
+        try:
+            os.remove(self.state_path)
+        except OSError:
+            pass
+        return self.path
+
+    def verify(self):
+        if os.path.getsize(self.part_path) != self.size:
+            self.discard()
+            raise IOError("size mismatch: {}".format(self.url))
+        if self.sha256 is not None:
+            sha = hashlib.sha256()
+            with open(self.part_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    sha.update(chunk)
+            if sha.hexdigest() != self.sha256:
+                self.discard()
+                raise IOError("sha256 mismatch: {}".format(self.url))
+
+    def discard(self):
+        for path in (self.part_path, self.state_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def requests_file_response(response, path, delete=True, headers=None):
+    """
+    以response的信息构造读取本地文件的requests.Response(状态码200)
+    """
+    import requests
+    new_response = requests.Response()
+    new_response.status_code = 200
+    new_response.headers = response.headers if headers is None else headers
+    new_response.url = response.url
+    new_response.reason = "OK"
+    new_response.encoding = response.encoding
+    new_response.history = response.history
+    new_response.request = response.request
+    new_response.connection = response.connection
+    new_response.cookies = response.cookies
+    new_response.elapsed = response.elapsed
+    new_response.raw = DownloadedFile(path, delete)
+    return new_response
+
+
+def urllib_file_response(headers, url, path, delete=True):
+    import urllib.response
+    return urllib.response.addinfourl(DownloadedFile(path, delete), headers, url, 200)
+
+
+def requests_range_getter(session, url, headers, origin_request, original_url=None):
+    """
+    使用未打补丁的requests.Session.request下载分段
+    """
+    from urllib.parse import urlparse
+    range_headers = dict(headers or {})
+    # 重定向到其他域名(如CDN签名地址)时不转发认证信息
+    if original_url is not None and urlparse(original_url).netloc != urlparse(url).netloc:
+        range_headers = {k: v for k, v in range_headers.items() if k.lower() != "authorization"}
+
+    def get_range(start, end):
+        part_headers = dict(range_headers)
+        part_headers["Range"] = "bytes={}-{}".format(start, end)
+        response = origin_request(session, "GET", url, headers=part_headers, stream=True, timeout=60)
+        try:
+            if response.status_code != 206:
+                raise IOError("range request not supported, status {}".format(response.status_code))
+            yield from response.iter_content(1024 * 1024)
+        finally:
+            response.close()
+    return get_range
+
+
+def urllib_range_getter(opener, url, headers, origin_open, original_url=None):
+    """
+    使用未打补丁的OpenerDirector.open下载分段
+    """
+    import urllib.request
+    from urllib.parse import urlparse
+    range_headers = dict(headers or {})
+    if original_url is not None and urlparse(original_url).netloc != urlparse(url).netloc:
+        range_headers = {k: v for k, v in range_headers.items() if k.lower() != "authorization"}
+
+    def get_range(start, end):
+        part_headers = dict(range_headers)
+        part_headers["Range"] = "bytes={}-{}".format(start, end)
+        response = origin_open(opener, urllib.request.Request(url, headers=part_headers), None, 60)
+        try:
+            if response.status != 206:
+                raise IOError("range request not supported, status {}".format(response.status))
+            yield from iter(lambda: response.read(1024 * 1024), b"")
+        finally:
+            response.close()
+    return get_range
+
+
+def accelerate_requests(session, response, request_headers, origin_request, original_url=None):
+    """
+    对requests的响应(stream=True，还未读取内容)做分段并发下载，返回读取本地文件的requests.Response，不能加速时返回None
+    """
+    # 内容已经读取到内存时再分段下载会重复下载
+    if response._content_consumed:
+        return None
+    if not should_accelerate(response.status_code, response.headers, request_headers):
+        return None
+    size = int(response.headers["Content-Length"])
+    url = response.url
+    validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+    sha256 = expected_sha256(response.headers)
+    # 丢弃第一个响应的连接，后续用分段请求下载
+    response.close()
+    print("[easyapi] parallel download {} ({:.1f} MB)".format(url, size / 1024 / 1024))
+    downloader = RangeDownloader(url, size, requests_range_getter(session, url, request_headers, origin_request,
+                                                                  original_url), sha256, validator)
+    path = downloader.download()
+    return requests_file_response(response, path)
+
+
+def probe_requests(session, head_response, request_headers, origin_request, original_url=None):
+    """
+    stream=False时在发送GET请求之前调用，head_response是HEAD请求(已跟随重定向)的响应，
+    可以分段下载时直接分段并发下载，返回读取本地文件的requests.Response，不能加速时返回None(调用方再发送GET请求)
+    """
+    head_response.close()
+    if not should_accelerate(head_response.status_code, head_response.headers, request_headers):
+        return None
+    size = int(head_response.headers["Content-Length"])
+    url = head_response.url
+    validator = head_response.headers.get("ETag") or head_response.headers.get("Last-Modified")
+    sha256 = expected_sha256(head_response.headers)
+    print("[easyapi] parallel download {} ({:.1f} MB)".format(url, size / 1024 / 1024))
+    downloader = RangeDownloader(url, size, requests_range_getter(session, url, request_headers, origin_request,
+                                                                  original_url), sha256, validator)
+    path = downloader.download()
+    return requests_file_response(head_response, path)
+
+
+def accelerate_urllib(opener, response, request_headers, origin_open, original_url=None):
+    """
+    对urllib的响应做分段并发下载，返回读取本地文件的响应，不能加速时返回None
+    """
+    status = getattr(response, "status", None) or response.getcode()
+    if not should_accelerate(status, response.headers, request_headers):
+        return None
+    size = int(response.headers["Content-Length"])
+    url = response.geturl()
+    validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+    sha256 = expected_sha256(response.headers)
+    response.close()
+    print("[easyapi] parallel download {} ({:.1f} MB)".format(url, size / 1024 / 1024))
+    downloader = RangeDownloader(url, size, urllib_range_getter(opener, url, request_headers, origin_open,
+                                                                original_url), sha256, validator)
+    path = downloader.download()
+    return urllib_file_response(response.headers, url, path)
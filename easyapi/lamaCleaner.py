@@ -0,0 +1,235 @@
+import asyncio
+import math
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+import folder_paths
+from .settings import get_setting_value
+
+lama_model_dir = os.path.join(folder_paths.models_dir, "lama")
+lama_model_path = os.path.join(lama_model_dir, "big-lama.pt")
+if not os.path.exists(lama_model_path):
+    os.environ['LAMA_MODEL'] = lama_model_path
+    print(f"## lama model not found: {lama_model_path}, pls download from https://github.com/enesmsahin/simple-lama-inpainting/releases/download/v0.1.0/big-lama.pt")
+else:
+    os.environ['LAMA_MODEL'] = lama_model_path
+os.makedirs(lama_model_dir, exist_ok=True)
+
+
+class LamaTask:
+    def __init__(self, image, mask):
+        self.image = image
+        self.mask = mask
+        self.future = Future()
+
+    @property
+    def size_key(self):
+        return self.image.size, self.mask.size
+
+
+class LamaWorker:
+    """
+    lama推理专用线程，推理不占用aiohttp的事件循环。
+    队列中尺寸相同的请求会合并成一个批次推理，批次大小通过配置项lama_max_batch_size设置(默认4)
+    """
+
+    def __init__(self):
+        self.model = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="easyapi_lama", daemon=True)
+                self._thread.start()
+
+    def submit(self, image, mask):
+        """
+        Returns: concurrent.futures.Future，结果为修复后的PIL图片
+        """
+        self._ensure_started()
+        task = LamaTask(image, mask)
+        self._queue.put(task)
+        return task.future
+
+    def warm_up(self):
+        """
+        在工作线程中提前加载模型
+        """
+        self._ensure_started()
+        self._queue.put(None)
+
+    def _load_model(self):
+        if self.model is None:
+            from simple_lama_inpainting import SimpleLama
+            self.model = SimpleLama()
+            print("[easyapi] lama model loaded")
+        return self.model
+
+    def _run(self):
+        pending = []
+        while True:
+            if len(pending) == 0:
+                pending.append(self._queue.get())
+            # 取出队列中已经到达的请求，不额外等待
+            while True:
+                try:
+                    pending.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            task = pending.pop(0)
+            if task is None:
+                try:
+                    self._load_model()
+                except Exception as e:
+                    print(f"[easyapi] fail to load lama model, error: {e}")
+                continue
+
+            max_batch_size = max(1, int(get_setting_value("lama_max_batch_size", 4)))
+            batch = [task]
+            for other in list(pending):
+                if len(batch) >= max_batch_size:
+                    break
+                if other is not None and other.size_key == task.size_key:
+                    batch.append(other)
+                    pending.remove(other)
+            self._process(batch)
+
+    def _process(self, batch):
+        try:
+            model = self._load_model()
+            if len(batch) == 1:
+                results = [model(batch[0].image, batch[0].mask)]
+            else:
+                results = self._infer_batch(model, batch)
+        except Exception as e:
+            for task in batch:
+                task.future.set_exception(e)
+            return
+        for task, result in zip(batch, results):
+            task.future.set_result(result)
+
+    @staticmethod
+    def _infer_batch(model, batch):
+        """
+        同尺寸的图片拼成一个批次推理，后处理与SimpleLama.__call__相同
+        """
+        import numpy as np
+        import torch
+        from PIL import Image
+        from simple_lama_inpainting.utils.util import prepare_img_and_mask
+
+        prepared = [prepare_img_and_mask(task.image, task.mask, model.device) for task in batch]
+        images = torch.cat([image for image, _ in prepared], dim=0)
+        masks = torch.cat([mask for _, mask in prepared], dim=0)
+        with torch.inference_mode():
+            inpainted = model.model(images, masks)
+            results = inpainted.permute(0, 2, 3, 1).detach().cpu().numpy()
+            results = np.clip(results * 255, 0, 255).astype(np.uint8)
+        return [Image.fromarray(result) for result in results]
+
+
+class LamaLimiter:
+    """
+    限制同时处理的请求数(lama_max_in_flight，默认2)和排队等待的请求数(lama_max_queued，默认8)，
+    排队已满时拒绝请求，防止突发请求占满内存。只在事件循环中使用，计数的检查和修改都在self._condition中进行
+    """
+
+    def __init__(self):
+        self.in_flight = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+        # 最近请求的耗时(秒)，包含排队时间
+        self.latencies = deque(maxlen=500)
+        self._condition = None
+
+    @property
+    def max_in_flight(self):
+        return max(1, int(get_setting_value("lama_max_in_flight", 2)))
+
+    @property
+    def max_queued(self):
+        return max(0, int(get_setting_value("lama_max_queued", 8)))
+
+    async def acquire(self):
+        """
+        Returns: 是否获取成功，排队已满时返回False
+        """
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            if self.in_flight >= self.max_in_flight:
+                if self.queued >= self.max_queued:
+                    self.rejected += 1
+                    return False
+                self.queued += 1
+                try:
+                    await self._condition.wait_for(lambda: self.in_flight < self.max_in_flight)
+                finally:
+                    self.queued -= 1
+            self.in_flight += 1
+            return True
+
+    async def release(self, start_time):
+        async with self._condition:
+            self.in_flight -= 1
+            self.completed += 1
+            self.latencies.append(time.monotonic() - start_time)
+            # 唤醒所有等待的请求重新检查，被唤醒的请求已经取消(如客户端断开)时不会丢失空位
+            self._condition.notify_all()
+
+    async def wake(self):
+        """
+        修改lama_max_in_flight后唤醒等待的请求
+        """
+        if self._condition is None:
+            return
+        async with self._condition:
+            self._condition.notify_all()
+
+    def percentile(self, percent):
+        if len(self.latencies) == 0:
+            return None
+        latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(math.ceil(percent / 100 * len(latencies))) - 1)
+        return latencies[max(0, index)]
+
+    def retry_after(self):
+        """
+        根据中位耗时估算排队中的请求处理完需要的秒数
+        """
+        p50 = self.percentile(50) or 1
+        return max(1, int(math.ceil(p50 * (self.queued + self.in_flight) / self.max_in_flight)))
+
+    def status(self):
+        latency = {}
+        for percent in (50, 90, 99):
+            value = self.percentile(percent)
+            latency["p" + str(percent)] = None if value is None else round(value * 1000, 1)
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_in_flight": self.max_in_flight,
+            "max_queued": self.max_queued,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "latency_ms": latency,
+        }
+
+
+lama_worker = LamaWorker()
+lama_limiter = LamaLimiter()
+
+
+def init():
+    # 启动时预加载模型，避免第一次请求等待
+    if get_setting_value("lama_preload", False):
+        lama_worker.warm_up()
@@ -1,20 +1,186 @@
+import atexit
+import json
+import queue
 import sys
+import threading
+import time
 
 from datetime import datetime as dt
 
 from server import PromptServer
+from .settings import get_setting_value
 
 old_stdout = sys.stdout
 old_stderr = sys.stderr
 
 
+class LogSink:
+    """
+    日志写入队列，由后台线程批量写入原始的stdout/stderr，打印日志的线程只记录时间并放入队列。
+    队列大小通过配置项log_queue_size设置(默认10000)，队列已满时丢弃stdout的日志并计数，stderr的日志不丢弃(等待写入)。
+    配置项log_format为json时按行输出JSON(time、stream、message)
+    """
+
+    # 每批最多合并的消息数
+    BATCH_SIZE = 1000
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=max(1, int(get_setting_value("log_queue_size", 10000))))
+        # 按输出流记录当前行是否已经开始，以及json格式下未结束的行
+        self._newline = {True: True, False: True}
+        self._pending = {True: None, False: None}
+        self._thread = None
+        self._lock = threading.Lock()
+        # 每个线程当前行的状态，用于按行丢弃
+        self._local = threading.local()
+        self.written = 0
+        self.dropped = 0
+        self._reported_dropped = 0
+        self.max_queued = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="easyapi_log", daemon=True)
+                self._thread.start()
+
+    def put(self, is_stdout, message):
+        item = (is_stdout, time.time(), message)
+        # 后台线程自身打印的日志不能等待，否则会阻塞写入
+        if is_stdout or threading.current_thread() is self._thread:
+            # 按行丢弃：一行中有片段被丢弃后，丢弃这一行剩余的片段；已经写入部分片段的行保留换行符
+            state = self._local.__dict__
+            if message == '\n':
+                if state.get("dropping"):
+                    state["dropping"] = False
+                    if not state.get("line_started"):
+                        self.dropped += 1
+                        return
+                    self._queue.put(item)
+                    state["line_started"] = False
+                    return
+                state["line_started"] = False
+            elif state.get("dropping"):
+                self.dropped += 1
+                return
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self.dropped += 1
+                state["dropping"] = True
+                return
+            if message != '\n':
+                state["line_started"] = True
+        else:
+            self._queue.put(item)
+        queued = self._queue.qsize()
+        if queued > self.max_queued:
+            self.max_queued = queued
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            while len(items) < self.BATCH_SIZE:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in items
+            self._write([item for item in items if item is not None])
+            for _ in items:
+                self._queue.task_done()
+            if stop:
+                return
+
+    def _write(self, items):
+        json_format = get_setting_value("log_format", "text") == "json"
+        # 按原来的顺序写入，连续的同一输出流的日志合并成一次写入，切换输出流时先写入之前的
+        out = []
+        for is_stdout, timestamp, message in items:
+            if len(out) == 0 or out[-1][0] != is_stdout:
+                out.append((is_stdout, []))
+            if json_format:
+                self._format_json(out[-1][1], is_stdout, timestamp, message)
+            else:
+                self._format_text(out[-1][1], is_stdout, timestamp, message)
+        self.written += len(items)
+        if self.dropped != self._reported_dropped:
+            out.append((False, ['%s [easyapi] log queue full, dropped %d messages\n'
+                                % (str(dt.now()), self.dropped - self._reported_dropped)]))
+            self._reported_dropped = self.dropped
+        for is_stdout, parts in out:
+            if len(parts) == 0:
+                continue
+            stream = old_stdout if is_stdout else old_stderr
+            try:
+                stream.write(''.join(parts))
+                stream.flush()
+            except Exception:
+                pass
+
+    def _format_text(self, parts, is_stdout, timestamp, message):
+        # 与原来的格式相同：每行第一次写入时加上时间前缀
+        if message == '\n':
+            parts.append(message)
+            self._newline[is_stdout] = True
+        elif self._newline[is_stdout]:
+            parts.append('%s %s' % (str(dt.fromtimestamp(timestamp)), message))
+            self._newline[is_stdout] = False
+        else:
+            parts.append(message)
+
+    def _format_json(self, parts, is_stdout, timestamp, message):
+        pending = self._pending[is_stdout]
+        if pending is None:
+            pending = self._pending[is_stdout] = [timestamp, []]
+        lines = message.split('\n')
+        for line in lines[:-1]:
+            pending[1].append(line)
+            parts.append(json.dumps({
+                "time": str(dt.fromtimestamp(pending[0])),
+                "stream": "stdout" if is_stdout else "stderr",
+                "message": ''.join(pending[1]),
+            }, ensure_ascii=False) + '\n')
+            pending = self._pending[is_stdout] = [timestamp, []]
+        if lines[-1]:
+            pending[1].append(lines[-1])
+
+    def close(self, timeout=5):
+        """
+        写入队列中剩余的日志，退出时调用
+        """
+        if self._thread is None or not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize(),
+            "max_queue_size": self._queue.maxsize,
+            "max_queued": self.max_queued,
+            "written": self.written,
+            "dropped": self.dropped,
+        }
+
+
+log_sink = None
+
+
 class StdTimeFilter:
-    def __init__(self, is_stdout):
+    def __init__(self, is_stdout, sink=None):
         self.is_stdout = is_stdout
         self.newline = True
         self.encoding = "utf-8"
+        self.sink = sink
 
     def write(self, message):
+        if self.sink is not None:
+            self.sink.put(self.is_stdout, message)
+            return
         if message == '\n':
             if self.is_stdout:
                 old_stdout.write(message)
@@ -36,6 +202,9 @@ class StdTimeFilter:
                 old_stderr.write(message)
 
     def flush(self):
+        # 使用队列时由后台线程在每批写入后flush
+        if self.sink is not None:
+            return
         if self.is_stdout:
             old_stdout.flush()
         else:
@@ -57,7 +226,13 @@ def socket_wrap(func):
 
 
 def log_wrap():
-    sys.stdout = StdTimeFilter(True)
-    sys.stderr = StdTimeFilter(False)
+    global log_sink
+    # 配置项log_async为false时同步写入
+    if get_setting_value("log_async", True):
+        log_sink = LogSink()
+        log_sink.start()
+        atexit.register(log_sink.close)
+    sys.stdout = StdTimeFilter(True, log_sink)
+    sys.stderr = StdTimeFilter(False, log_sink)
     # old_send_sync = PromptServer.instance.send_sync
     # PromptServer.instance.send_sync = socket_wrap(old_send_sync)
@@ -1,6 +1,14 @@
+import importlib.abc
+import re
+import sys
+import threading
+import time
 from enum import Enum
+from urllib.parse import urlparse
 
-from .settings import get_settings
+from .settings import get_settings, get_setting_value, settings_version
+from . import downloader
+from .artifactCache import artifact_cache, store_requests_response, store_urllib_response
 import copy
 
 mirror_url = [
@@ -61,29 +69,430 @@ def get_custom_mirrors(mirror_type=None):
     return base_mirrors
 
 
-def replace_mirror_url():
-    from urllib.parse import urlparse
-
-    def replace_url(url: str, mirror_type: Mirror = None):
-        u = urlparse(url)
-        netloc = u.netloc
-        found = False
-        user_agent = None
-        for mirror in get_custom_mirrors(mirror_type):
-            if netloc is not None and len(netloc) > 0 and netloc.lower() == mirror['o_url'] and mirror['n_url'] != 'None':
-                u = u._replace(netloc=mirror['n_url'])
-                print('[easyapi] origin url: {}, use mirror url: {}'.format(url, u.geturl()))
-                if 'u_agent' in mirror:
-                    user_agent = mirror['u_agent']
-                found = True
+# 编译后的镜像表，key是Mirror类型，值是{原始域名: 镜像}
+_mirror_tables = {}
+_mirror_tables_version = None
+_mirror_tables_lock = threading.Lock()
+
+
+def parse_mirror_candidates(n_url):
+    """
+    镜像配置可以是单个地址，也可以是逗号分隔的多个地址或列表，按配置顺序作为候选镜像
+    """
+    if isinstance(n_url, (list, tuple)):
+        items = n_url
+    else:
+        items = str(n_url).split(',')
+    candidates = []
+    for item in items:
+        item = str(item).strip().rstrip('/')
+        if item and item != 'None' and item not in candidates:
+            candidates.append(item)
+    return candidates
+
+
+def get_mirror_table(mirror_type):
+    """
+    获取原始域名到镜像的映射，只在配置变化时重新生成，请求时不读取配置文件
+    """
+    global _mirror_tables, _mirror_tables_version
+    if _mirror_tables_version != settings_version():
+        with _mirror_tables_lock:
+            if _mirror_tables_version != settings_version():
+                tables = {}
+                for m_type in Mirror:
+                    table = {}
+                    for mirror in get_custom_mirrors(m_type):
+                        candidates = parse_mirror_candidates(mirror['n_url'])
+                        if len(candidates) > 0:
+                            table[mirror['o_url']] = dict(mirror, candidates=candidates)
+                    tables[m_type] = table
+                _mirror_tables = tables
+                # 生成镜像表时可能重新加载了配置，所以在生成之后读取版本号
+                _mirror_tables_version = settings_version()
+    return _mirror_tables.get(mirror_type, {})
+
+
+class MirrorHealth:
+    """
+    记录每个镜像的健康状态和延迟。
+    后台线程定时向所有候选镜像发送HEAD请求测量延迟(间隔通过配置项mirror_probe_interval设置，默认300秒，0表示不探测)，
+    请求失败(连接错误、超时、5xx)的镜像标记为不可用，探测或请求成功后恢复。
+    每个原始域名固定使用上一次成功的镜像，只有它不可用或者其他镜像快30%以上时才切换，避免频繁切换镜像
+    """
+
+    # 其他镜像的延迟低于当前镜像的多少倍时才切换
+    SWITCH_RATIO = 0.7
+    PROBE_TIMEOUT = 5
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key是镜像地址
+        self._mirrors = {}
+        # key是(Mirror类型, 原始域名)，值是当前使用的镜像地址
+        self._selected = {}
+        self._thread = None
+        self._wake = threading.Event()
+
+    @staticmethod
+    def _new_entry():
+        return {"latency": None, "healthy": True, "failures": 0, "successes": 0,
+                "last_error": None, "last_probe": None}
+
+    def _entry(self, n_url):
+        entry = self._mirrors.get(n_url)
+        if entry is None:
+            entry = self._mirrors[n_url] = self._new_entry()
+        return entry
+
+    def _order(self, mirror_type, mirror):
+        """
+        只读，调用方需持有self._lock
+        Returns: (排序后的候选镜像, 需要切换到的镜像，不切换时为None)
+        """
+        candidates = mirror['candidates']
+        entries = {n_url: self._mirrors.get(n_url) or self._new_entry() for n_url in candidates}
+        selected = self._selected.get((mirror_type, mirror['o_url']))
+        healthy = [n_url for n_url in candidates if entries[n_url]["healthy"]]
+        unhealthy = [n_url for n_url in candidates if not entries[n_url]["healthy"]]
+        # 延迟未知的镜像保持配置顺序，排在已测量的镜像之后
+        healthy.sort(key=lambda n_url: (entries[n_url]["latency"] is None, entries[n_url]["latency"] or 0))
+        switch = None
+        if selected in healthy and healthy[0] != selected:
+            fastest = entries[healthy[0]]["latency"]
+            current = entries[selected]["latency"]
+            if fastest is not None and current is not None and fastest < current * self.SWITCH_RATIO:
+                switch = healthy[0]
+            else:
+                healthy.remove(selected)
+                healthy.insert(0, selected)
+        return healthy + unhealthy, switch
+
+    def order(self, mirror_type, mirror):
+        """
+        Returns: 按优先级排序的候选镜像，可用的镜像在前，不可用的镜像作为最后的备选
+        """
+        if len(mirror['candidates']) == 1:
+            return mirror['candidates']
+        with self._lock:
+            order, switch = self._order(mirror_type, mirror)
+            if switch is not None:
+                self._selected[(mirror_type, mirror['o_url'])] = switch
+        return order
+
+    def record_success(self, mirror_type, o_url, n_url):
+        with self._lock:
+            entry = self._entry(n_url)
+            entry["healthy"] = True
+            entry["failures"] = 0
+            entry["successes"] += 1
+            self._selected[(mirror_type, o_url)] = n_url
+
+    def record_failure(self, n_url, error):
+        with self._lock:
+            entry = self._entry(n_url)
+            entry["healthy"] = False
+            entry["failures"] += 1
+            entry["last_error"] = str(error)
+
+    def probe(self, n_url):
+        """
+        向镜像发送HEAD请求，状态码小于500即认为可用
+        """
+        import http.client
+        host, _, path = n_url.partition('/')
+        start = time.monotonic()
+        error = None
+        try:
+            conn = http.client.HTTPSConnection(host, timeout=self.PROBE_TIMEOUT)
+            try:
+                conn.request("HEAD", "/" + path)
+                status = conn.getresponse().status
+            finally:
+                conn.close()
+            if status >= 500:
+                error = "HTTP {}".format(status)
+        except Exception as e:
+            error = e
+        latency = time.monotonic() - start
+        with self._lock:
+            entry = self._entry(n_url)
+            entry["last_probe"] = time.time()
+            if error is None:
+                # 平滑延迟，避免单次波动导致切换
+                entry["latency"] = latency if entry["latency"] is None else entry["latency"] * 0.5 + latency * 0.5
+                entry["healthy"] = True
+                entry["failures"] = 0
+            else:
+                entry["healthy"] = False
+                entry["failures"] += 1
+                entry["last_error"] = str(error)
+
+    def probe_all(self):
+        n_urls = []
+        for m_type in Mirror:
+            for mirror in get_mirror_table(m_type).values():
+                n_urls.extend(n_url for n_url in mirror['candidates'] if n_url not in n_urls)
+        for n_url in n_urls:
+            self.probe(n_url)
+
+    @staticmethod
+    def probe_interval():
+        return float(get_setting_value("mirror_probe_interval", 300))
+
+    def _run(self):
+        while True:
+            interval = self.probe_interval()
+            if interval > 0:
+                try:
+                    self.probe_all()
+                except Exception as e:
+                    print("[easyapi] fail to probe mirrors, error: {}".format(e))
+            self._wake.wait(interval if interval > 0 else 60)
+            self._wake.clear()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="easyapi_mirror_probe", daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        """
+        立即重新探测
+        """
+        self._wake.set()
+
+    def status(self):
+        """
+        只读取状态，不切换镜像也不创建记录
+        """
+        result = {"probe_interval": self.probe_interval(), "mirrors": {}}
+        for m_type in Mirror:
+            table = get_mirror_table(m_type)
+            origins = {}
+            for o_url, mirror in table.items():
+                with self._lock:
+                    order, _ = self._order(m_type, mirror)
+                    origins[o_url] = {
+                        "selected": self._selected.get((m_type, o_url)),
+                        "order": order,
+                        "candidates": {n_url: dict(self._mirrors.get(n_url) or self._new_entry())
+                                       for n_url in mirror['candidates']},
+                    }
+            result["mirrors"][m_type.name.lower()] = origins
+        return result
+
+
+mirror_health = MirrorHealth()
+
+
+def mirror_candidates(url: str, mirror_type: Mirror = None):
+    """
+    Returns: (镜像配置, 按优先级排序的[(镜像地址, 替换后的url)])，没有配置镜像时返回(None, [])
+    """
+    u = urlparse(url)
+    netloc = u.netloc
+    if not netloc:
+        return None, []
+    mirror = get_mirror_table(mirror_type).get(netloc.lower())
+    if mirror is None:
+        return None, []
+    return mirror, [(n_url, u._replace(netloc=n_url).geturl()) for n_url in mirror_health.order(mirror_type, mirror)]
+
+
+def call_with_mirrors(url, mirror_type, call, is_retryable, is_server_error=None, close=None):
+    """
+    依次尝试候选镜像，连接失败、超时或返回5xx时切换到下一个镜像，最后一个镜像的结果原样返回
+    Args:
+        call: call(url, u_agent)，url是替换后的地址，没有配置镜像时是原始地址
+        is_retryable: 判断异常是否需要切换镜像
+        is_server_error: 判断返回结果是否是5xx
+        close: 释放需要丢弃的返回结果
+    """
+    mirror, candidates = mirror_candidates(url, mirror_type)
+    if mirror is None:
+        return call(url, None)
+    for i, (n_url, new_url) in enumerate(candidates):
+        last = i == len(candidates) - 1
+        print('[easyapi] origin url: {}, use mirror url: {}'.format(url, new_url))
+        try:
+            result = call(new_url, mirror.get('u_agent'))
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            mirror_health.record_failure(n_url, e)
+            if last:
+                raise
+            print('[easyapi] mirror {} failed, error: {}, try next mirror'.format(n_url, e))
+            continue
+        if is_server_error is not None and is_server_error(result):
+            mirror_health.record_failure(n_url, "server error")
+            if not last:
+                print('[easyapi] mirror {} returned server error, try next mirror'.format(n_url))
+                if close is not None:
+                    close(result)
+                continue
+            return result
+        mirror_health.record_success(mirror_type, mirror['o_url'], n_url)
+        return result
+
+
+async def async_call_with_mirrors(url, mirror_type, call, is_retryable, is_server_error=None, close=None):
+    """
+    call_with_mirrors的异步版本，call返回coroutine
+    """
+    mirror, candidates = mirror_candidates(url, mirror_type)
+    if mirror is None:
+        return await call(url, None)
+    for i, (n_url, new_url) in enumerate(candidates):
+        last = i == len(candidates) - 1
+        print('[easyapi] origin url: {}, use mirror url: {}'.format(url, new_url))
+        try:
+            result = await call(new_url, mirror.get('u_agent'))
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            mirror_health.record_failure(n_url, e)
+            if last:
+                raise
+            print('[easyapi] mirror {} failed, error: {}, try next mirror'.format(n_url, e))
+            continue
+        if is_server_error is not None and is_server_error(result):
+            mirror_health.record_failure(n_url, "server error")
+            if not last:
+                print('[easyapi] mirror {} returned server error, try next mirror'.format(n_url))
+                if close is not None:
+                    close(result)
+                continue
+            return result
+        mirror_health.record_success(mirror_type, mirror['o_url'], n_url)
+        return result
+
+
+def _get_url_arg(args, kwargs, key, index=2):
+    if key in kwargs:
+        return kwargs[key]
+    if len(args) > index:
+        return args[index]
+    return None
+
+
+def _set_url_arg(args, kwargs, key, url, index=2):
+    if key in kwargs:
+        kwargs = dict(kwargs)
+        kwargs[key] = url
+    else:
+        args = args[:index] + (url,) + args[index + 1:]
+    return args, kwargs
+
+
+class _ImportHook(importlib.abc.MetaPathFinder):
+    """
+    模块第一次导入完成后执行回调，用于在requests、aiohttp、git被使用时才打补丁，不在启动时导入这些库
+    """
+
+    def __init__(self):
+        self.callbacks = {}
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname not in self.callbacks:
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
                 break
-        return found, u, user_agent
+        else:
+            return None
+        loader = spec.loader
+        if loader is None or not hasattr(loader, "exec_module"):
+            return None
+        callbacks = self.callbacks.pop(fullname)
+        exec_module = loader.exec_module
+
+        def exec_and_patch(module):
+            exec_module(module)
+            for callback in callbacks:
+                _run_patch(fullname, callback)
+
+        loader.exec_module = exec_and_patch
+        return spec
+
+
+_import_hook = _ImportHook()
+
+
+def _run_patch(name, callback):
+    try:
+        callback()
+    except Exception as e:
+        print("[easyapi] fail to apply mirror url patch for {}, error: {} ".format(name, e))
 
+
+def when_imported(name, callback):
+    """
+    模块已经导入时立即执行回调，否则在模块第一次导入完成后执行
+    """
+    if name in sys.modules:
+        _run_patch(name, callback)
+        return
+    _import_hook.callbacks.setdefault(name, []).append(callback)
+    if _import_hook not in sys.meta_path:
+        sys.meta_path.insert(0, _import_hook)
+
+
+def patch_urllib():
+
+    import http.client
     import urllib.request
+    import urllib.error
     import socket
     # open(self, fullurl, data=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT)
     origin_urllib_open = urllib.request.OpenerDirector.open
 
+    def urllib_retryable(e):
+        if isinstance(e, urllib.error.HTTPError):
+            return e.code >= 500
+        return isinstance(e, OSError)
+
+    def download_urllib(obj, url, headers, method, request, extra_headers):
+        """
+        先查询共享缓存(发送条件请求)，再按需分段并发下载，最后保存到共享缓存
+        """
+        use_cache = artifact_cache.request_cacheable(method, headers)
+        record = artifact_cache.lookup(url) if use_cache else None
+        if record is not None:
+            extra_headers.update(artifact_cache.conditional_headers(record))
+        try:
+            response = request()
+        except urllib.error.HTTPError as e:
+            if record is None or e.code != 304:
+                raise
+            e.close()
+            print('[easyapi] use cached artifact: {}'.format(url))
+            headers = artifact_cache.record_headers(record, http.client.HTTPMessage())
+            return downloader.urllib_file_response(headers, e.geturl(), artifact_cache.materialize(record, True))
+        finally:
+            extra_headers.clear()
+        if method == 'GET' and downloader.accelerate_enabled():
+            try:
+                accelerated = downloader.accelerate_urllib(obj, response, headers, origin_urllib_open, url)
+                if accelerated is not None:
+                    response = accelerated
+            except Exception as e:
+                # 分段下载失败时使用普通请求重新下载
+                print('[easyapi] fail to download {} in parallel, error: {}'.format(url, e))
+                response = request()
+        if use_cache and artifact_cache.cacheable(response.status, response.headers):
+            try:
+                return store_urllib_response(url, response)
+            except Exception as e:
+                print('[easyapi] fail to cache {}, error: {}'.format(url, e))
+                return request()
+        return response
+
     def wrap_open(obj, fullurl, data=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
         """
         implement of lib urllib
@@ -94,32 +503,48 @@ def replace_mirror_url():
         Returns:
 
         """
+        # 命中缓存时追加的条件请求头
+        extra_headers = {}
         if isinstance(fullurl, str):
-            found, u, user_agent = replace_url(fullurl, Mirror.DOWN_MODEL)
-            if found:
-                url = u.geturl()
-                if user_agent is not None:
-                    headers = {'User-Agent': user_agent}
+            def call(url, user_agent):
+                headers = dict(extra_headers)
+                if url != fullurl and user_agent is not None:
+                    headers['User-Agent'] = user_agent
+                if headers:
                     url = urllib.request.Request(url, data=data, headers=headers)
-
                 return origin_urllib_open.__call__(obj, url, data, timeout)
-            else:
-                return origin_urllib_open.__call__(obj, fullurl, data, timeout)
+
+            return download_urllib(obj, fullurl, {}, 'GET' if data is None else 'POST',
+                                   lambda: call_with_mirrors(fullurl, Mirror.DOWN_MODEL, call, urllib_retryable),
+                                   extra_headers)
 
         else:
             # url is urllib.request.Request
             full_url = fullurl.get_full_url()
-            found, u, user_agent = replace_url(full_url, Mirror.DOWN_MODEL)
-            if found:
-                fullurl.full_url = u.geturl()
-                if user_agent is not None:
-                    if fullurl.headers is not None:
-                        fullurl.headers['User-Agent'] = user_agent
-                    else:
-                        fullurl.headers = {'User-Agent': user_agent}
 
-            return origin_urllib_open.__call__(obj, fullurl, data, timeout)
+            def call(url, user_agent):
+                if url != full_url:
+                    fullurl.full_url = url
+                    if user_agent is not None:
+                        if fullurl.headers is not None:
+                            fullurl.headers['User-Agent'] = user_agent
+                        else:
+                            fullurl.headers = {'User-Agent': user_agent}
+                request = fullurl
+                if extra_headers:
+                    # 条件请求头只加在副本上，不修改调用方的Request
+                    request = urllib.request.Request(fullurl.full_url, data=fullurl.data, method=fullurl.get_method(),
+                                                     headers=dict(fullurl.header_items(), **extra_headers))
+                return origin_urllib_open.__call__(obj, request, data, timeout)
+
+            method = fullurl.get_method() if data is None else 'POST'
+            return download_urllib(obj, full_url, dict(fullurl.header_items()), method,
+                                   lambda: call_with_mirrors(full_url, Mirror.DOWN_MODEL, call, urllib_retryable),
+                                   extra_headers)
+    urllib.request.OpenerDirector.open = wrap_open
+
 
+def patch_requests():
     import requests
     origin_request = requests.Session.request
 
@@ -133,26 +558,84 @@ def replace_mirror_url():
         Returns:
 
         """
+        url = _get_url_arg(args, kwargs, 'url')
+        if not isinstance(url, str):
+            return origin_request.__call__(*args, **kwargs)
+
+        method = str(_get_url_arg(args, kwargs, 'method', 1)).upper()
+        request_headers = kwargs.get('headers')
+        # 命中缓存时追加的条件请求头
+        extra_headers = {}
+
+        def call(new_url, user_agent):
+            new_args, new_kwargs = _set_url_arg(args, kwargs, 'url', new_url)
+            if extra_headers:
+                new_kwargs = dict(new_kwargs)
+                new_kwargs['headers'] = dict(request_headers or {}, **extra_headers)
+            return origin_request.__call__(*new_args, **new_kwargs)
+
+        def call_head(new_url, user_agent):
+            head_kwargs = {key: kwargs[key] for key in ('auth', 'cookies', 'proxies', 'verify', 'cert') if key in kwargs}
+            return origin_request(args[0], 'HEAD', new_url, headers=request_headers, allow_redirects=True,
+                                  timeout=kwargs.get('timeout') or 30, **head_kwargs)
+
+        def request(call_func=call):
+            return call_with_mirrors(url, Mirror.DOWN_MODEL, call_func,
+                                     lambda e: isinstance(e, (requests.ConnectionError, requests.Timeout)),
+                                     lambda response: response.status_code >= 500,
+                                     lambda response: response.close())
+
+        # 先查询共享缓存(发送条件请求)，再按需分段并发下载，最后保存到共享缓存
+        use_cache = artifact_cache.request_cacheable(method, request_headers)
+        record = artifact_cache.lookup(url) if use_cache else None
+        accelerate = method == 'GET' and downloader.accelerate_enabled()
+        stream = bool(kwargs.get('stream'))
+        response = None
+        if accelerate and not stream and record is None:
+            # stream=False时GET请求返回前已经把内容读到内存，先用HEAD请求判断是否需要分段下载
+            try:
+                response = downloader.probe_requests(args[0], request(call_head), request_headers, origin_request, url)
+            except Exception as e:
+                print('[easyapi] fail to download {} in parallel, error: {}'.format(url, e))
+        if response is None:
+            if record is not None:
+                extra_headers.update(artifact_cache.conditional_headers(record))
+            try:
+                response = request()
+            finally:
+                extra_headers.clear()
+            if record is not None and response.status_code == 304:
+                response.close()
+                print('[easyapi] use cached artifact: {}'.format(url))
+                headers = artifact_cache.record_headers(record, requests.structures.CaseInsensitiveDict())
+                return downloader.requests_file_response(response, artifact_cache.materialize(record, True),
+                                                         headers=headers)
+            if accelerate and stream:
+                try:
+                    accelerated = downloader.accelerate_requests(args[0], response, request_headers, origin_request,
+                                                                 url)
+                    if accelerated is not None:
+                        response = accelerated
+                except Exception as e:
+                    # 分段下载失败时使用普通请求重新下载
+                    print('[easyapi] fail to download {} in parallel, error: {}'.format(url, e))
+                    response = request()
+        if use_cache and artifact_cache.cacheable(response.status_code, response.headers):
+            try:
+                return store_requests_response(url, response)
+            except Exception as e:
+                print('[easyapi] fail to cache {}, error: {}'.format(url, e))
+                return request()
+        return response
+    requests.Session.request = wrap_requests
 
-        if 'url' in kwargs:
-            url = kwargs['url']
-            found, u, user_agent = replace_url(url, Mirror.DOWN_MODEL)
-            if found:
-                kwargs['url'] = u.geturl()
-        elif len(args) >= 3:
-            url = args[2]
-            found, u, user_agent = replace_url(url, Mirror.DOWN_MODEL)
-            if found:
-                new_updater = list(args)
-                new_updater[2] = u.geturl()
-                args = tuple(new_updater)
-
-        return origin_request.__call__(*args, **kwargs)
 
+def patch_aiohttp():
     import aiohttp
+    import asyncio
     origin_async_request = aiohttp.ClientSession._request
 
-    def wrap_aiohttp_requests(*args, **kwargs):
+    async def wrap_aiohttp_requests(*args, **kwargs):
         """
         implement of lib aiohttp
         Args:
@@ -162,22 +645,43 @@ def replace_mirror_url():
         Returns:
 
         """
+        url = _get_url_arg(args, kwargs, 'str_or_url')
+        if url is None:
+            return await origin_async_request.__call__(*args, **kwargs)
+
+        def call(new_url, user_agent):
+            new_args, new_kwargs = _set_url_arg(args, kwargs, 'str_or_url', new_url if new_url != str(url) else url)
+            return origin_async_request.__call__(*new_args, **new_kwargs)
+
+        return await async_call_with_mirrors(str(url), Mirror.DOWN_MODEL, call,
+                                             lambda e: isinstance(e, (aiohttp.ClientConnectionError, asyncio.TimeoutError)),
+                                             lambda response: response.status >= 500,
+                                             lambda response: response.release())
+    aiohttp.ClientSession._request = wrap_aiohttp_requests
 
-        if 'str_or_url' in kwargs:
-            url = kwargs['str_or_url']
-            found, u, user_agent = replace_url(url, Mirror.DOWN_MODEL)
-            if found:
-                kwargs['str_or_url'] = u.geturl()
-        elif len(args) >= 3:
-            url = args[2]
-            found, u, user_agent = replace_url(url, Mirror.DOWN_MODEL)
-            if found:
-                new_updater = list(args)
-                new_updater[2] = u.geturl()
-                args = tuple(new_updater)
 
-        return origin_async_request.__call__(*args, **kwargs)
+# git的错误输出中表示网络错误或远程不可达的内容(小写)，只有这些错误切换到下一个镜像
+GIT_NETWORK_ERRORS = ("could not resolve host", "could not resolve proxy", "failed to connect", "connection timed out",
+                      "connection refused", "connection reset", "operation timed out", "network is unreachable",
+                      "early eof", "rpc failed", "remote end hung up", "ssl", "gnutls", "tls connection")
+GIT_HTTP_STATUS = re.compile(r"returned error: (\d{3})")
 
+
+def git_retryable(e):
+    """
+    只有网络错误和5xx切换镜像，认证失败、仓库或分支不存在、本地目录冲突等错误直接抛出
+    """
+    import git
+    if not isinstance(e, git.GitCommandError):
+        return False
+    stderr = str(e.stderr or "").lower()
+    match = GIT_HTTP_STATUS.search(stderr)
+    if match is not None:
+        return int(match.group(1)) >= 500
+    return any(error in stderr for error in GIT_NETWORK_ERRORS)
+
+
+def patch_git():
     import git
     origin_git_clone = git.Repo._clone
 
@@ -185,33 +689,44 @@ def replace_mirror_url():
         """
         implement of lib git clone
         Args:
-            **args: cls, git, url
+            **args: git, url, path
             **kwargs:
 
         Returns:
 
         """
+        url = _get_url_arg(args, kwargs, 'url', 1)
+        if not isinstance(url, str):
+            return origin_git_clone.__call__(*args, **kwargs)
+
+        def call(new_url, user_agent):
+            if artifact_cache.enabled and urlparse(new_url).scheme in ('http', 'https'):
+                try:
+                    mirror_path = artifact_cache.git_mirror(url, new_url)
+                except git.GitCommandError:
+                    raise
+                except Exception as e:
+                    print('[easyapi] fail to use git cache for {}, error: {}'.format(url, e))
+                else:
+                    # 从本地镜像克隆，再把远程地址改回实际下载的地址
+                    new_args, new_kwargs = _set_url_arg(args, kwargs, 'url', mirror_path, 1)
+                    repo = origin_git_clone.__call__(*new_args, **new_kwargs)
+                    for remote in repo.remotes:
+                        remote.set_url(new_url)
+                    return repo
+            new_args, new_kwargs = _set_url_arg(args, kwargs, 'url', new_url, 1)
+            return origin_git_clone.__call__(*new_args, **new_kwargs)
+
+        return call_with_mirrors(url, Mirror.GIT_CLONE, call, git_retryable)
+    git.Repo._clone = wrap_git_clone
 
-        if 'url' in kwargs:
-            url = kwargs['url']
-            found, u, user_agent = replace_url(url, Mirror.GIT_CLONE)
-            if found:
-                kwargs['url'] = u.geturl()
-        elif len(args) >= 3:
-            url = args[2]
-            found, u, user_agent = replace_url(url, Mirror.GIT_CLONE)
-            if found:
-                new_updater = list(args)
-                new_updater[2] = u.geturl()
-                args = tuple(new_updater)
-
-        return origin_git_clone.__call__(*args, **kwargs)
 
+def replace_mirror_url():
     # urllib.request.urlopen = wrap_urlopen
-    urllib.request.OpenerDirector.open = wrap_open
-    requests.Session.request = wrap_requests
-    aiohttp.ClientSession._request = wrap_aiohttp_requests
-    git.Repo._clone = wrap_git_clone
+    patch_urllib()
+    when_imported("requests", patch_requests)
+    when_imported("aiohttp", patch_aiohttp)
+    when_imported("git", patch_git)
 
     # try:
         # manager has been not loaded
@@ -239,3 +754,4 @@ def init():
         replace_mirror_url()
     except Exception as e:
         print("[easyapi] fail to apply mirror url patch, error: {} ".format(e))
+    mirror_health.start()
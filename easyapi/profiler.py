@@ -0,0 +1,205 @@
+import functools
+import inspect
+import sys
+import threading
+import time
+
+from .cache import sizeof_tensors
+from .settings import get_setting_value
+
+try:
+    import resource
+except ImportError:
+    # windows没有resource模块，不统计内存
+    resource = None
+
+# 耗时直方图的分桶上限(秒)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+_local = threading.local()
+_lock = threading.Lock()
+# key是节点类名
+_metrics = {}
+
+
+def enabled():
+    return bool(get_setting_value("node_profiler", False))
+
+
+def _peak_rss():
+    """
+    Returns: 进程的峰值内存(字节)
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux单位是KB，macOS是字节
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _new_metric():
+    return {
+        "count": 0,
+        "errors": 0,
+        "wall_seconds": 0.0,
+        "wall_max": 0.0,
+        "cpu_seconds": 0.0,
+        "peak_rss_delta_max": 0,
+        "peak_rss_delta_sum": 0,
+        "input_tensor_bytes": 0,
+        "output_tensor_bytes": 0,
+        "buckets": [0] * len(BUCKETS),
+    }
+
+
+def record(class_name, wall, cpu, rss_delta, input_bytes, output_bytes, error=False):
+    with _lock:
+        metric = _metrics.get(class_name)
+        if metric is None:
+            metric = _metrics[class_name] = _new_metric()
+        metric["count"] += 1
+        if error:
+            metric["errors"] += 1
+        metric["wall_seconds"] += wall
+        metric["wall_max"] = max(metric["wall_max"], wall)
+        metric["cpu_seconds"] += cpu
+        if rss_delta is not None:
+            metric["peak_rss_delta_max"] = max(metric["peak_rss_delta_max"], rss_delta)
+            metric["peak_rss_delta_sum"] += rss_delta
+        metric["input_tensor_bytes"] += input_bytes
+        metric["output_tensor_bytes"] += output_bytes
+        for i, bucket in enumerate(BUCKETS):
+            if wall <= bucket:
+                metric["buckets"][i] += 1
+                break
+
+
+def _profile(class_name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # 只记录最外层的调用，节点内部调用其他节点方法时不重复统计
+        if getattr(_local, "depth", 0) > 0 or not enabled():
+            return func(*args, **kwargs)
+        _local.depth = 1
+        input_bytes = sizeof_tensors(list(args) + list(kwargs.values()))
+        rss = _peak_rss()
+        # 只统计执行节点的线程，线程池中并行编码等工作不计入
+        cpu = time.thread_time()
+        start = time.perf_counter()
+        error = True
+        result = None
+        try:
+            result = func(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            wall = time.perf_counter() - start
+            cpu = time.thread_time() - cpu
+            rss_delta = None if rss is None else _peak_rss() - rss
+            _local.depth = 0
+            record(class_name, wall, cpu, rss_delta, input_bytes, sizeof_tensors(result), error)
+
+    wrapper._easyapi_profiled = True
+    return wrapper
+
+
+def wrap_node_class(class_name, cls):
+    """
+    替换节点类的FUNCTION方法，统计每次执行的耗时、CPU时间、峰值内存增量和输入输出张量大小
+    """
+    name = getattr(cls, "FUNCTION", None)
+    if name is None:
+        return
+    try:
+        attr = inspect.getattr_static(cls, name)
+    except AttributeError:
+        return
+    if isinstance(attr, (staticmethod, classmethod)):
+        func = attr.__func__
+    else:
+        func = attr
+    if not callable(func):
+        return
+    if getattr(func, "_easyapi_profiled", False):
+        # 已经在本类替换过，或者继承自已替换的父类方法
+        if name in cls.__dict__:
+            return
+        func = func.__wrapped__
+    wrapper = _profile(class_name, func)
+    if isinstance(attr, staticmethod):
+        wrapper = staticmethod(wrapper)
+    elif isinstance(attr, classmethod):
+        wrapper = classmethod(wrapper)
+    setattr(cls, name, wrapper)
+
+
+def wrap_nodes(node_class_mappings):
+    for class_name, cls in node_class_mappings.items():
+        try:
+            wrap_node_class(class_name, cls)
+        except Exception as e:
+            print("[easyapi] fail to profile node {}, error: {}".format(class_name, e))
+
+
+def reset():
+    with _lock:
+        _metrics.clear()
+
+
+def metrics_json():
+    with _lock:
+        metrics = {name: dict(metric, buckets=list(metric["buckets"])) for name, metric in _metrics.items()}
+    result = {}
+    for name, metric in metrics.items():
+        count = metric["count"]
+        cumulative = 0
+        histogram = {}
+        for bucket, value in zip(BUCKETS, metric["buckets"]):
+            cumulative += value
+            histogram["+Inf" if bucket == float("inf") else repr(float(bucket))] = cumulative
+        result[name] = {
+            "count": count,
+            "errors": metric["errors"],
+            "wall_seconds": {"sum": metric["wall_seconds"], "avg": metric["wall_seconds"] / count if count else 0,
+                             "max": metric["wall_max"]},
+            "cpu_seconds": {"sum": metric["cpu_seconds"], "avg": metric["cpu_seconds"] / count if count else 0},
+            "peak_rss_delta_bytes": {"max": metric["peak_rss_delta_max"], "sum": metric["peak_rss_delta_sum"]},
+            "input_tensor_bytes": metric["input_tensor_bytes"],
+            "output_tensor_bytes": metric["output_tensor_bytes"],
+            "wall_seconds_histogram": histogram,
+        }
+    return {"enabled": enabled(), "nodes": result}
+
+
+def metrics_prometheus():
+    """
+    Prometheus文本格式
+    """
+    with _lock:
+        metrics = {name: dict(metric, buckets=list(metric["buckets"])) for name, metric in _metrics.items()}
+    lines = [
+        "# HELP easyapi_node_duration_seconds Wall time of EasyApi node executions.",
+        "# TYPE easyapi_node_duration_seconds histogram",
+    ]
+    for name, metric in sorted(metrics.items()):
+        cumulative = 0
+        for bucket, value in zip(BUCKETS, metric["buckets"]):
+            cumulative += value
+            le = "+Inf" if bucket == float("inf") else repr(float(bucket))
+            lines.append('easyapi_node_duration_seconds_bucket{{class="{}",le="{}"}} {}'.format(name, le, cumulative))
+        lines.append('easyapi_node_duration_seconds_sum{{class="{}"}} {}'.format(name, metric["wall_seconds"]))
+        lines.append('easyapi_node_duration_seconds_count{{class="{}"}} {}'.format(name, metric["count"]))
+    counters = (
+        ("easyapi_node_cpu_seconds_total", "counter", "Thread CPU time of EasyApi node executions.", "cpu_seconds"),
+        ("easyapi_node_errors_total", "counter", "EasyApi node executions that raised.", "errors"),
+        ("easyapi_node_peak_rss_delta_bytes", "gauge", "Largest growth of peak RSS during one execution.",
+         "peak_rss_delta_max"),
+        ("easyapi_node_input_tensor_bytes_total", "counter", "Bytes of input tensors.", "input_tensor_bytes"),
+        ("easyapi_node_output_tensor_bytes_total", "counter", "Bytes of output tensors.", "output_tensor_bytes"),
+    )
+    for metric_name, metric_type, help_text, key in counters:
+        lines.append("# HELP {} {}".format(metric_name, help_text))
+        lines.append("# TYPE {} {}".format(metric_name, metric_type))
+        for name, metric in sorted(metrics.items()):
+            lines.append('{}{{class="{}"}} {}'.format(metric_name, name, metric[key]))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,294 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+from server import PromptServer
+from .settings import get_setting_value
+
+# 每个prompt最多保存的事件数
+MAX_EVENTS = 1000
+FINISHED = ("success", "error", "interrupted", "cancelled")
+
+
+class PromptRecord:
+    """
+    单个prompt的状态和事件，事件的序号从1开始递增。
+    不保存节点输出(可能包含base64图片)，输出从历史记录中读取，内存受history_max_size/history_max_bytes限制
+    """
+
+    def __init__(self, prompt_id):
+        self.prompt_id = prompt_id
+        self.state = "queued"
+        self.seq = 0
+        self.events = []
+        self.time = time.time()
+        # (事件循环, future)，有新事件时唤醒
+        self.waiters = []
+
+    @property
+    def finished(self):
+        return self.state in FINISHED
+
+    def add(self, event, data):
+        # 连续的进度事件只保留最新的一条，序号仍然递增
+        if event == "progress" and len(self.events) > 0 and self.events[-1][1] == "progress":
+            self.events.pop()
+        self.seq += 1
+        self.events.append((self.seq, event, data))
+        if len(self.events) > MAX_EVENTS:
+            del self.events[:len(self.events) - MAX_EVENTS]
+
+    def events_since(self, seq):
+        # 调用方需持有PromptEventIndex._lock，执行线程会同时修改events
+        # 序号连续递增，从后往前找
+        index = len(self.events)
+        while index > 0 and self.events[index - 1][0] > seq:
+            index -= 1
+        return [{"id": s, "event": event, "data": data} for s, event, data in self.events[index:]]
+
+    def snapshot(self, since=None):
+        # 调用方需持有PromptEventIndex._lock，不包含输出
+        result = {"prompt_id": self.prompt_id, "status": self.state, "seq": self.seq}
+        if since is not None:
+            result["events"] = self.events_since(since)
+        return result
+
+
+class PromptEventIndex:
+    """
+    按prompt_id保存执行事件，包装send_sync、prompt_queue.put和task_done。
+    查询单个prompt的状态只需要一次字典查找，不需要遍历或序列化历史记录。
+    最多保存prompt_events_max_size个执行结束的prompt(默认1000)，超过时删除最早结束的，排队中和正在执行的prompt不会被删除
+    """
+
+    def __init__(self):
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def max_size(self):
+        return max(1, int(get_setting_value("prompt_events_max_size", 1000)))
+
+    def get(self, prompt_id):
+        with self._lock:
+            return self._records.get(prompt_id)
+
+    def _record(self, prompt_id):
+        """
+        调用方需持有self._lock
+        """
+        record = self._records.get(prompt_id)
+        if record is None:
+            record = self._records[prompt_id] = PromptRecord(prompt_id)
+            self._evict()
+        return record
+
+    def _evict(self):
+        """
+        按加入顺序删除执行结束的prompt，调用方需持有self._lock。
+        被删除的prompt已经是结束状态，持有它的请求不会继续等待
+        """
+        excess = len(self._records) - self.max_size
+        if excess <= 0:
+            return
+        evicted = []
+        for prompt_id, record in self._records.items():
+            if len(evicted) >= excess:
+                break
+            if record.finished:
+                evicted.append(prompt_id)
+        for prompt_id in evicted:
+            self._notify(self._records.pop(prompt_id))
+
+    def track(self, prompt_id, state):
+        """
+        索引中没有但还在队列中的prompt(如索引初始化之前放入队列的)，加入索引以便收到之后的事件
+        """
+        with self._lock:
+            record = self._records.get(prompt_id)
+            if record is None:
+                record = self._record(prompt_id)
+                record.state = state
+            return record
+
+    def _notify(self, record):
+        """
+        唤醒等待的请求，调用方需持有self._lock
+        """
+        for loop, future in record.waiters:
+            loop.call_soon_threadsafe(_set_done, future)
+        record.waiters = []
+
+    def on_queued(self, prompt_id):
+        with self._lock:
+            record = self._records.pop(prompt_id, None)
+            # 重新提交相同的prompt_id时重新记录
+            if record is not None and not record.finished:
+                self._records[prompt_id] = record
+                return
+            self._record(prompt_id)
+
+    def on_event(self, event, data):
+        if not isinstance(data, dict):
+            return
+        prompt_id = data.get("prompt_id")
+        if prompt_id is None:
+            return
+        with self._lock:
+            record = self._record(prompt_id)
+            if record.finished:
+                return
+            if event == "execution_start":
+                record.state = "running"
+            elif event == "executed":
+                # 输出在历史记录中，事件只保存节点id
+                data = {key: value for key, value in data.items() if key != "output"}
+            elif event == "execution_error":
+                record.state = "error"
+            elif event == "execution_interrupted":
+                record.state = "interrupted"
+            record.add(event, data)
+            self._notify(record)
+
+    def on_task_done(self, prompt_id, entry):
+        """
+        执行完成，使用历史记录中的状态
+        """
+        with self._lock:
+            record = self._record(prompt_id)
+            if entry is not None:
+                status = entry.get("status") or {}
+                if record.state not in ("error", "interrupted"):
+                    record.state = "error" if status.get("status_str", "success") != "success" else "success"
+            elif not record.finished:
+                record.state = "success"
+            record.add("done", {"prompt_id": prompt_id, "status": record.state})
+            self._notify(record)
+
+    def on_cancelled(self, prompt_id):
+        """
+        prompt执行前从队列中删除
+        """
+        with self._lock:
+            record = self._records.get(prompt_id)
+            if record is None or record.finished:
+                return
+            record.state = "cancelled"
+            record.add("done", {"prompt_id": prompt_id, "status": record.state})
+            self._notify(record)
+
+    def snapshot(self, record, since=None):
+        """
+        加锁读取prompt的状态和序号大于since的事件，since为None时只返回最新状态(events为空)。
+        执行结束时包含历史记录中的输出，历史记录已被删除时输出为空
+        """
+        with self._lock:
+            result = record.snapshot(record.seq if since is None else since)
+            finished = record.finished
+        if finished:
+            result["outputs"] = history_outputs(record.prompt_id)
+        return result
+
+    async def wait(self, record, seq, timeout, until_finished=False):
+        """
+        等待序号大于seq的事件(until_finished为True时等待执行结束)，超时返回False
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            remaining = deadline - loop.time()
+            with self._lock:
+                if record.finished or (not until_finished and record.seq > seq):
+                    return True
+                if remaining <= 0:
+                    return False
+                future = loop.create_future()
+                record.waiters.append((loop, future))
+            try:
+                await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                with self._lock:
+                    if (loop, future) in record.waiters:
+                        record.waiters.remove((loop, future))
+                    return record.finished or (not until_finished and record.seq > seq)
+
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+
+prompt_events = PromptEventIndex()
+
+
+def history_outputs(prompt_id):
+    prompt_queue = PromptServer.instance.prompt_queue
+    with prompt_queue.mutex:
+        entry = prompt_queue.history.get(prompt_id)
+    if entry is None:
+        return {}
+    return entry.get("outputs", {})
+
+
+def record_from_history(prompt_id):
+    """
+    事件索引中没有(如重启前或已被删除)但历史记录中有的prompt
+    """
+    prompt_queue = PromptServer.instance.prompt_queue
+    with prompt_queue.mutex:
+        entry = prompt_queue.history.get(prompt_id)
+    if entry is None:
+        return None
+    record = PromptRecord(prompt_id)
+    status = entry.get("status") or {}
+    record.state = "error" if status.get("status_str", "success") != "success" else "success"
+    return record
+
+
+def wrap_send_sync(server):
+    origin_send_sync = server.send_sync
+
+    def send_sync(event, data, sid=None):
+        try:
+            prompt_events.on_event(event, data)
+        except Exception as e:
+            print("[easyapi] fail to record prompt event, error: {}".format(e))
+        return origin_send_sync(event, data, sid)
+
+    server.send_sync = send_sync
+
+
+def wrap_prompt_queue(prompt_queue):
+    origin_put = prompt_queue.put
+    origin_task_done = prompt_queue.task_done
+
+    def put(item):
+        result = origin_put(item)
+        prompt_events.on_queued(item[1])
+        return result
+
+    def task_done(item_id, *args, **kwargs):
+        with prompt_queue.mutex:
+            item = prompt_queue.currently_running.get(item_id)
+        result = origin_task_done(item_id, *args, **kwargs)
+        if item is not None:
+            try:
+                with prompt_queue.mutex:
+                    entry = prompt_queue.history.get(item[1])
+                prompt_events.on_task_done(item[1], entry)
+            except Exception as e:
+                print("[easyapi] fail to record prompt event, error: {}".format(e))
+        return result
+
+    prompt_queue.put = put
+    prompt_queue.task_done = task_done
+
+
+def init():
+    server = PromptServer.instance
+    prompt_queue = getattr(server, "prompt_queue", None)
+    if prompt_queue is None:
+        return
+    wrap_send_sync(server)
+    wrap_prompt_queue(prompt_queue)
@@ -0,0 +1,138 @@
+import sys
+from collections import OrderedDict
+from itertools import islice
+
+import execution
+from server import PromptServer
+from .settings import get_setting_value
+
+
+def trim_history(history, max_size):
+    """
+    删除最早的历史记录，只保留max_size条，只遍历需要删除的key。调用方需持有prompt_queue.mutex
+    Returns: 删除的条数
+    """
+    count = len(history) - max(0, max_size)
+    if count <= 0:
+        return 0
+    for key in list(islice(history, count)):
+        history.pop(key, None)
+    return count
+
+
+def deep_sizeof(obj):
+    """
+    递归计算对象占用的内存(字节)，相同对象只计算一次，张量按数据大小计算
+    """
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        value = stack.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        if hasattr(value, "element_size") and hasattr(value, "nelement"):
+            size += value.element_size() * value.nelement()
+            continue
+        size += sys.getsizeof(value)
+        if isinstance(value, dict):
+            stack.extend(value.keys())
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            stack.extend(value)
+    return size
+
+
+class HistorySizeTracker:
+    """
+    按内存大小限制历史记录，上限通过配置项history_max_bytes设置(MB，默认0表示不限制)。
+    每条记录的大小在执行完成(task_done)时计算一次，保存base64图片的记录按实际大小计算，超过上限时删除最早的记录
+    """
+
+    def __init__(self):
+        # key是prompt_id，值是记录的大小，顺序与history相同
+        self.sizes = OrderedDict()
+        self.total = 0
+        self.evictions = 0
+
+    @property
+    def max_bytes(self):
+        return int(float(get_setting_value("history_max_bytes", 0)) * 1024 * 1024)
+
+    def _sync(self, history):
+        """
+        history可能被其他代码修改(按条数删除、清空、删除单条)，删除已经不存在的记录，条数不一致时重新统计
+        """
+        while len(self.sizes) > 0:
+            key = next(iter(self.sizes))
+            if key in history:
+                break
+            self.total -= self.sizes.pop(key)
+        if len(self.sizes) != len(history):
+            sizes = OrderedDict()
+            for key, entry in history.items():
+                size = self.sizes.get(key)
+                sizes[key] = deep_sizeof(entry) if size is None else size
+            self.sizes = sizes
+            self.total = sum(sizes.values())
+
+    def on_task_done(self, history):
+        """
+        记录新增的历史记录大小并按上限删除，调用方需持有prompt_queue.mutex
+        """
+        if len(history) > 0:
+            key = next(reversed(history))
+            if key not in self.sizes:
+                size = deep_sizeof(history[key])
+                self.sizes[key] = size
+                self.total += size
+        self._sync(history)
+        max_bytes = self.max_bytes
+        if max_bytes <= 0:
+            return
+        # 至少保留最新的一条
+        while self.total > max_bytes and len(self.sizes) > 1:
+            key, size = self.sizes.popitem(last=False)
+            self.total -= size
+            history.pop(key, None)
+            self.evictions += 1
+
+    def stats(self, history):
+        self._sync(history)
+        return {
+            "entries": len(history),
+            "size": self.total,
+            "max_size": execution.MAXIMUM_HISTORY_SIZE,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+        }
+
+
+history_tracker = HistorySizeTracker()
+
+
+def wrap_task_done(prompt_queue):
+    origin_task_done = prompt_queue.task_done
+
+    def task_done(*args, **kwargs):
+        result = origin_task_done(*args, **kwargs)
+        try:
+            with prompt_queue.mutex:
+                history_tracker.on_task_done(prompt_queue.history)
+        except Exception as e:
+            print("[easyapi] fail to update history size, error: {}".format(e))
+        return result
+
+    prompt_queue.task_done = task_done
+
+
+def init():
+    prompt_queue = getattr(PromptServer.instance, "prompt_queue", None)
+    if prompt_queue is None:
+        return
+    # 启动时恢复保存的历史记录条数
+    max_size = get_setting_value("history_max_size")
+    if max_size is not None:
+        execution.MAXIMUM_HISTORY_SIZE = int(max_size)
+    wrap_task_done(prompt_queue)
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import threading
+import time
+
+from server import PromptServer
+from .cache import LRUCache
+from .promptHistory import deep_sizeof
+from .settings import get_setting_value
+
+
+def prompt_hash(prompt):
+    """
+    prompt的规范化json(key排序、无空白)的sha256，base64等内联输入包含在内
+    """
+    data = json.dumps(prompt, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class PromptMemo:
+    """
+    相同prompt的执行结果缓存。执行成功后按prompt的hash保存outputs，有效期内再次提交相同的prompt时直接返回结果；
+    相同的prompt还在队列中或正在执行时返回该prompt_id，不重复放入队列。
+    配置项prompt_memo_ttl有效期(秒，默认600)，prompt_memo_max_size容量(MB，默认256)
+    """
+
+    def __init__(self):
+        # 值是(过期时间, prompt_id, outputs)
+        self.results = LRUCache("prompt_memo", "prompt_memo_max_size", 256, sizeof=lambda value: deep_sizeof(value[2]))
+        # key是hash，值是队列中的prompt_id
+        self._in_flight = {}
+        # key是prompt_id，值是hash
+        self._keys = {}
+        self._lock = threading.Lock()
+        self.attached = 0
+
+    @property
+    def ttl(self):
+        return float(get_setting_value("prompt_memo_ttl", 600))
+
+    def lookup(self, key, prompt_queue):
+        """
+        Returns: ("hit", prompt_id, outputs)、("in_flight", prompt_id, None)或None
+        """
+        value = self.results.get(key)
+        if value is not None:
+            expires, prompt_id, outputs = value
+            if expires > time.time():
+                return "hit", prompt_id, outputs
+            self.results.pop(key)
+        with self._lock:
+            prompt_id = self._in_flight.get(key)
+        if prompt_id is None:
+            return None
+        # 已经从队列中删除(取消)的prompt不会执行完成
+        if not self._is_pending(prompt_queue, prompt_id):
+            self.forget(prompt_id)
+            return None
+        self.attached += 1
+        return "in_flight", prompt_id, None
+
+    @staticmethod
+    def _is_pending(prompt_queue, prompt_id):
+        """
+        使用公平排队的prompt_id索引，不遍历队列；正在执行的prompt通常只有一个
+        """
+        # promptQueue导入了本模块，在使用时导入
+        from .promptQueue import fair_scheduler
+        with prompt_queue.mutex:
+            for item in prompt_queue.currently_running.values():
+                if item[1] == prompt_id:
+                    return True
+            return len(fair_scheduler.queued_ids(prompt_queue, [prompt_id])) > 0
+
+    def register(self, key, prompt_id):
+        with self._lock:
+            self._in_flight[key] = prompt_id
+            self._keys[prompt_id] = key
+
+    def forget(self, prompt_id):
+        with self._lock:
+            key = self._keys.pop(prompt_id, None)
+            if key is not None and self._in_flight.get(key) == prompt_id:
+                del self._in_flight[key]
+        return key
+
+    def on_task_done(self, prompt_id, entry):
+        """
+        prompt执行完成，只缓存执行成功的结果
+        """
+        key = self.forget(prompt_id)
+        if key is None or entry is None:
+            return
+        status = entry.get("status")
+        if status is not None and (status.get("status_str", "success") != "success" or not status.get("completed", True)):
+            return
+        ttl = self.ttl
+        if ttl <= 0:
+            return
+        self.results.put(key, (time.time() + ttl, prompt_id, entry.get("outputs", {})))
+
+    def clear(self):
+        self.results.clear()
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._in_flight)
+        return dict(self.results.stats(), in_flight=in_flight, attached=self.attached, ttl=self.ttl)
+
+
+prompt_memo = PromptMemo()
+
+
+def _history_entry(prompt_queue, prompt_id, args, kwargs):
+    """
+    从历史记录中读取执行结果，历史记录条数为0时从task_done的参数中读取
+    """
+    with prompt_queue.mutex:
+        entry = prompt_queue.history.get(prompt_id)
+    if entry is not None:
+        return entry
+    result = args[1] if len(args) > 1 else kwargs.get("history_result", kwargs.get("outputs"))
+    status = args[2] if len(args) > 2 else kwargs.get("status")
+    if not isinstance(result, dict):
+        return None
+    if "outputs" not in result:
+        result = {"outputs": result}
+    if status is not None and not isinstance(status, dict):
+        status = status._asdict() if hasattr(status, "_asdict") else None
+    return dict(result, status=status)
+
+
+def wrap_task_done(prompt_queue):
+    origin_task_done = prompt_queue.task_done
+
+    def task_done(item_id, *args, **kwargs):
+        # task_done会从currently_running中删除，先取出prompt_id
+        with prompt_queue.mutex:
+            item = prompt_queue.currently_running.get(item_id)
+        result = origin_task_done(item_id, *args, **kwargs)
+        if item is not None:
+            try:
+                prompt_memo.on_task_done(item[1], _history_entry(prompt_queue, item[1], (item_id,) + args, kwargs))
+            except Exception as e:
+                print("[easyapi] fail to update prompt memo, error: {}".format(e))
+        return result
+
+    prompt_queue.task_done = task_done
+
+
+def init():
+    prompt_queue = getattr(PromptServer.instance, "prompt_queue", None)
+    if prompt_queue is None:
+        return
+    wrap_task_done(prompt_queue)
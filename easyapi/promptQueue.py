@@ -0,0 +1,441 @@
+import heapq
+import math
+import threading
+import time
+import uuid
+from collections import deque
+
+import nodes
+from server import PromptServer
+from .promptEvents import prompt_events
+from .promptMemo import prompt_memo
+from .settings import get_setting_value
+
+# 只能通过连接线输入的类型，批量提交时不能覆盖
+_SCALAR_TYPES = ("INT", "FLOAT", "STRING", "BOOLEAN")
+
+
+class OverrideError(ValueError):
+    pass
+
+
+def _input_spec(class_type, name, input_types_cache):
+    """
+    Returns: 节点输入的定义(类型, 参数)，没有该输入时返回None
+    """
+    input_types = input_types_cache.get(class_type)
+    if input_types is None:
+        node_class = nodes.NODE_CLASS_MAPPINGS.get(class_type)
+        if node_class is None:
+            return None
+        input_types = input_types_cache[class_type] = node_class.INPUT_TYPES()
+    for category in ("required", "optional"):
+        spec = input_types.get(category, {}).get(name)
+        if spec is not None:
+            return spec[0], spec[1] if len(spec) > 1 and isinstance(spec[1], dict) else {}
+    return None
+
+
+def check_override(class_type, name, value, input_types_cache):
+    """
+    按节点的INPUT_TYPES检查覆盖的值：下拉框的值必须在可选项中，数值在min/max范围内，不允许连接线
+    """
+    if isinstance(value, list):
+        raise OverrideError("links are not allowed")
+    spec = _input_spec(class_type, name, input_types_cache)
+    if spec is None:
+        raise OverrideError("unknown input")
+    input_type, options = spec
+    if isinstance(input_type, (list, tuple)):
+        if value not in input_type:
+            raise OverrideError("value not in list: {}".format(value))
+        return
+    if input_type not in _SCALAR_TYPES:
+        raise OverrideError("input type {} only accepts links".format(input_type))
+    if input_type == "BOOLEAN":
+        if not isinstance(value, bool):
+            raise OverrideError("expected BOOLEAN")
+        return
+    if input_type == "STRING":
+        if not isinstance(value, str):
+            raise OverrideError("expected STRING")
+        return
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or (input_type == "INT" and value != int(value)):
+        raise OverrideError("expected {}".format(input_type))
+    if "min" in options and value < options["min"]:
+        raise OverrideError("value smaller than min {}".format(options["min"]))
+    if "max" in options and value > options["max"]:
+        raise OverrideError("value bigger than max {}".format(options["max"]))
+
+
+def apply_overrides(template, overrides, input_types_cache):
+    """
+    生成覆盖了部分输入的prompt，overrides的格式为{节点id: {输入名: 值}}。
+    只复制被覆盖的节点，其余节点与模板共用，所以模板中的值(如base64图片)不会被复制
+    """
+    prompt = dict(template)
+    for node_id, inputs in (overrides or {}).items():
+        node_id = str(node_id)
+        node = template.get(node_id)
+        if node is None:
+            raise OverrideError("node {} not in prompt".format(node_id))
+        if not isinstance(inputs, dict):
+            raise OverrideError("inputs of node {} must be an object".format(node_id))
+        node_inputs = dict(node.get("inputs", {}))
+        for name, value in inputs.items():
+            if isinstance(node_inputs.get(name), list):
+                raise OverrideError("input {}.{} is linked in the prompt".format(node_id, name))
+            try:
+                check_override(node["class_type"], name, value, input_types_cache)
+            except OverrideError as e:
+                raise OverrideError("input {}.{}: {}".format(node_id, name, e))
+            node_inputs[name] = value
+        prompt[node_id] = dict(node, inputs=node_inputs)
+    return prompt
+
+
+def build_batch(template, items, extra_data=None, client_id=None):
+    """
+    按每一项的输入覆盖生成prompt
+    Returns: ([(prompt_id, prompt, extra_data)], {序号: 错误信息})
+    """
+    input_types_cache = {}
+    batch = []
+    errors = {}
+    prompt_ids = set()
+    for index, item in enumerate(items):
+        item = item or {}
+        prompt_id = str(item.get("prompt_id") or uuid.uuid4())
+        if prompt_id in prompt_ids:
+            errors[index] = "duplicate prompt_id: {}".format(prompt_id)
+            continue
+        prompt_ids.add(prompt_id)
+        try:
+            prompt = apply_overrides(template, item.get("inputs"), input_types_cache)
+        except OverrideError as e:
+            errors[index] = str(e)
+            continue
+        item_extra_data = dict(extra_data or {})
+        item_extra_data.update(item.get("extra_data") or {})
+        if client_id is not None:
+            item_extra_data["client_id"] = client_id
+        batch.append((prompt_id, prompt, item_extra_data))
+    return batch, errors
+
+
+class QueueFullError(Exception):
+    def __init__(self, priority, retry_after):
+        super().__init__("too many queued prompts in class {}".format(priority))
+        self.priority = priority
+        self.retry_after = retry_after
+
+
+class DuplicatePromptError(Exception):
+    def __init__(self, prompt_ids):
+        super().__init__("prompt_id already exists: {}".format(", ".join(prompt_ids)))
+        self.prompt_ids = prompt_ids
+
+
+def existing_prompt_ids(prompt_queue, prompt_ids):
+    """
+    在队列、正在执行和历史记录中已经存在的prompt_id，调用方需持有prompt_queue.mutex
+    """
+    prompt_ids = set(prompt_ids)
+    existing = set(prompt_ids.intersection(prompt_queue.history))
+    for item in prompt_queue.queue:
+        if item[1] in prompt_ids:
+            existing.add(item[1])
+    for item in prompt_queue.currently_running.values():
+        if item[1] in prompt_ids:
+            existing.add(item[1])
+    return existing
+
+
+def enqueue_batch(server, batch, outputs_to_execute, front=False, priority="default", client_id=None):
+    """
+    在一次加锁中把所有prompt放入队列，执行线程不会在中途取到部分prompt。
+    prompt_id已经在队列或历史记录中时抛出DuplicatePromptError，
+    front为False时按优先级和client_id公平排队，超过优先级的排队上限时抛出QueueFullError，都不放入任何prompt
+    Returns: 每个prompt的序号
+    """
+    prompt_queue = server.prompt_queue
+    numbers = []
+    with prompt_queue.mutex:
+        existing = existing_prompt_ids(prompt_queue, [prompt_id for prompt_id, _, _ in batch])
+        if len(existing) > 0:
+            raise DuplicatePromptError([prompt_id for prompt_id, _, _ in batch if prompt_id in existing])
+        if not front:
+            fair_scheduler.check_limit(prompt_queue, priority, len(batch))
+        for prompt_id, prompt, extra_data in batch:
+            if front:
+                number = -server.number
+                server.number += 1
+            else:
+                number = fair_scheduler.assign(server, priority, client_id)
+            prompt_queue.put((number, prompt_id, prompt, extra_data, outputs_to_execute))
+            numbers.append(number)
+    return numbers
+
+
+# 优先级的序号偏移，队列按序号从小到大执行，高优先级的prompt总是排在低优先级之前
+PRIORITY_OFFSETS = {"interactive": -1e12, "default": 0.0, "bulk": 1e12}
+
+
+def priority_of(number):
+    """
+    按序号判断prompt的优先级，ComfyUI的/prompt提交的prompt属于default
+    """
+    if number < -5e11:
+        return "interactive"
+    if number > 5e11:
+        return "bulk"
+    return "default"
+
+
+class FairScheduler:
+    """
+    在ComfyUI队列(按序号排序的堆)之上实现优先级和按client_id的加权公平排队。
+    每个优先级有一个虚拟时间(最近开始执行的prompt的序号)，client的下一个prompt的序号是
+    max(虚拟时间, 该client上一个prompt的序号) + 1/权重，所以一个client一次提交大量prompt时，
+    其他client新提交的prompt会排在它们之间，而不是全部排在后面。
+    ComfyUI的/prompt使用server.number作为序号，分配default的序号后把server.number推进到它之后，
+    所以/prompt提交的prompt总是排在之前放入的default prompt之后，相当于一个按提交顺序排队的client。
+    配置项prompt_client_weights设置client的权重(默认1)，prompt_class_max_queued设置每个优先级最多排队的数量(默认0不限制)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key是(优先级, client_id)，值是上一个prompt的虚拟完成时间
+        self._finish = {}
+        self._virtual = {priority: 0.0 for priority in PRIORITY_OFFSETS}
+        # 队列中的prompt，key是prompt_id，值是(优先级, 放入队列的时间, client_id)
+        self._pending = {}
+        self._counts = {priority: 0 for priority in PRIORITY_OFFSETS}
+        # 最近开始执行的prompt的排队时间(秒)
+        self._waits = {priority: deque(maxlen=1000) for priority in PRIORITY_OFFSETS}
+        self._started = {priority: 0 for priority in PRIORITY_OFFSETS}
+        self._start_times = deque(maxlen=50)
+
+    @staticmethod
+    def weight(client_id):
+        weights = get_setting_value("prompt_client_weights", {}) or {}
+        try:
+            return max(0.001, float(weights.get(client_id or "", 1)))
+        except (TypeError, ValueError):
+            return 1.0
+
+    @staticmethod
+    def max_queued(priority):
+        limits = get_setting_value("prompt_class_max_queued", {}) or {}
+        return int(limits.get(priority, 0))
+
+    def assign(self, server, priority, client_id=None):
+        """
+        计算新prompt的序号，调用方需持有prompt_queue.mutex并在同一次加锁中放入队列
+        """
+        with self._lock:
+            virtual = self._virtual[priority]
+            key = (priority, client_id or "")
+            finish = max(virtual, self._finish.get(key, virtual)) + 1.0 / self.weight(client_id)
+            self._finish[key] = finish
+            if len(self._finish) > 10000:
+                # 已经落后于虚拟时间的client不需要保存
+                self._finish = {k: v for k, v in self._finish.items() if v > self._virtual[k[0]]}
+            if priority == "default":
+                server.number = max(server.number, int(math.floor(finish)) + 1)
+            return PRIORITY_OFFSETS[priority] + finish
+
+    def _sync(self, prompt_queue):
+        """
+        放入队列都会经过put，只有其他代码删除队列中的prompt时数量会不一致，此时按队列重新统计。调用方需持有prompt_queue.mutex
+        """
+        if len(self._pending) == len(prompt_queue.queue):
+            return
+        now = time.time()
+        pending = {}
+        for item in prompt_queue.queue:
+            pending[item[1]] = self._pending.get(item[1]) or (priority_of(item[0]), now, _client_of(item))
+        self._pending = pending
+        self._counts = {priority: 0 for priority in PRIORITY_OFFSETS}
+        for priority, _, _ in pending.values():
+            self._counts[priority] += 1
+
+    def check_limit(self, prompt_queue, priority, count=1):
+        """
+        检查优先级的排队数量，超过上限时抛出QueueFullError
+        """
+        max_queued = self.max_queued(priority)
+        if max_queued <= 0:
+            return
+        with prompt_queue.mutex:
+            with self._lock:
+                self._sync(prompt_queue)
+                if self._counts[priority] + count > max_queued:
+                    raise QueueFullError(priority, self.retry_after())
+
+    def retry_after(self):
+        """
+        按最近开始执行的间隔估计的重试秒数
+        """
+        if len(self._start_times) < 2:
+            return 1
+        interval = (self._start_times[-1] - self._start_times[0]) / (len(self._start_times) - 1)
+        return max(1, int(math.ceil(interval)))
+
+    def on_put(self, item):
+        with self._lock:
+            if item[1] in self._pending:
+                return
+            priority = priority_of(item[0])
+            self._pending[item[1]] = (priority, time.time(), _client_of(item))
+            self._counts[priority] += 1
+
+    def on_started(self, item):
+        now = time.time()
+        priority = priority_of(item[0])
+        with self._lock:
+            pending = self._pending.pop(item[1], None)
+            if pending is not None:
+                self._counts[pending[0]] -= 1
+                self._waits[priority].append(now - pending[1])
+            self._started[priority] += 1
+            self._start_times.append(now)
+            self._virtual[priority] = max(self._virtual[priority], item[0] - PRIORITY_OFFSETS[priority])
+
+    def on_removed(self, prompt_ids):
+        """
+        prompt执行前从队列中删除
+        """
+        with self._lock:
+            for prompt_id in prompt_ids:
+                pending = self._pending.pop(prompt_id, None)
+                if pending is not None:
+                    self._counts[pending[0]] -= 1
+
+    def queued_ids(self, prompt_queue, prompt_ids, client_id=None):
+        """
+        按prompt_id索引查找队列中的prompt，指定client_id时同时查找该client的所有prompt。调用方需持有prompt_queue.mutex
+        Returns: 在队列中的prompt_id
+        """
+        with self._lock:
+            self._sync(prompt_queue)
+            queued = {prompt_id for prompt_id in prompt_ids if prompt_id in self._pending}
+            if client_id is not None:
+                queued.update(prompt_id for prompt_id, pending in self._pending.items() if pending[2] == client_id)
+            return queued
+
+    def status(self, prompt_queue):
+        now = time.time()
+        with prompt_queue.mutex:
+            with self._lock:
+                self._sync(prompt_queue)
+                pending = list(self._pending.values())
+                waits = {priority: sorted(values) for priority, values in self._waits.items()}
+                counts = dict(self._counts)
+                started = dict(self._started)
+        result = {}
+        for priority in PRIORITY_OFFSETS:
+            values = waits[priority]
+            queued_times = [t for p, t, _ in pending if p == priority]
+            result[priority] = {
+                "queued": counts[priority],
+                "max_queued": self.max_queued(priority),
+                "started": started[priority],
+                "oldest_wait_seconds": now - min(queued_times) if queued_times else 0,
+                # 最近1000个开始执行的prompt的排队时间
+                "wait_seconds": {
+                    "count": len(values),
+                    "avg": sum(values) / len(values) if values else 0,
+                    "p50": _percentile(values, 0.5),
+                    "p95": _percentile(values, 0.95),
+                    "max": values[-1] if values else 0,
+                },
+            }
+        return result
+
+
+def _client_of(item):
+    extra_data = item[3] if len(item) > 3 else None
+    return extra_data.get("client_id") if isinstance(extra_data, dict) else None
+
+
+def _percentile(values, q):
+    if len(values) == 0:
+        return 0
+    return values[min(len(values) - 1, int(math.ceil(q * len(values))) - 1)]
+
+
+fair_scheduler = FairScheduler()
+
+
+def cancel_prompts(server, prompt_ids=None, client_id=None):
+    """
+    批量取消prompt：按索引找到队列中的prompt，一次过滤后重建堆，正在执行的prompt发送中断。
+    Returns: {"running": [...], "queued": [...], "finished": [...], "not_found": [...]}
+    """
+    prompt_queue = server.prompt_queue
+    prompt_ids = set(prompt_ids or [])
+    with prompt_queue.mutex:
+        queued = fair_scheduler.queued_ids(prompt_queue, prompt_ids, client_id)
+        if len(queued) > 0:
+            prompt_queue.queue[:] = [item for item in prompt_queue.queue if item[1] not in queued]
+            heapq.heapify(prompt_queue.queue)
+            fair_scheduler.on_removed(queued)
+        running = [item[1] for item in prompt_queue.currently_running.values()
+                   if item[1] in prompt_ids or (client_id is not None and _client_of(item) == client_id)]
+        rest = prompt_ids - queued - set(running)
+        finished = [prompt_id for prompt_id in rest if prompt_id in prompt_queue.history]
+    if len(running) > 0:
+        nodes.interrupt_processing()
+    for prompt_id in queued:
+        prompt_events.on_cancelled(prompt_id)
+        prompt_memo.forget(prompt_id)
+    if len(queued) > 0 and hasattr(server, "queue_updated"):
+        server.queue_updated()
+    return {
+        "running": running,
+        "queued": sorted(queued),
+        "finished": sorted(finished),
+        "not_found": sorted(rest - set(finished)),
+    }
+
+
+def record_from_queue(server, prompt_id):
+    """
+    事件索引中没有但还在队列中或正在执行的prompt，按索引查找后加入事件索引
+    """
+    prompt_queue = server.prompt_queue
+    with prompt_queue.mutex:
+        if any(item[1] == prompt_id for item in prompt_queue.currently_running.values()):
+            return prompt_events.track(prompt_id, "running")
+        if len(fair_scheduler.queued_ids(prompt_queue, [prompt_id])) > 0:
+            return prompt_events.track(prompt_id, "queued")
+    return None
+
+
+def wrap_prompt_queue(prompt_queue):
+    origin_put = prompt_queue.put
+    origin_get = prompt_queue.get
+
+    # 索引和队列在同一次加锁中修改，mutex是RLock，get中等待时会完全释放
+    def put(item):
+        with prompt_queue.mutex:
+            fair_scheduler.on_put(item)
+            return origin_put(item)
+
+    def get(*args, **kwargs):
+        with prompt_queue.mutex:
+            result = origin_get(*args, **kwargs)
+            if result is not None:
+                fair_scheduler.on_started(result[0])
+            return result
+
+    prompt_queue.put = put
+    prompt_queue.get = get
+
+
+def init():
+    prompt_queue = getattr(PromptServer.instance, "prompt_queue", None)
+    if prompt_queue is None:
+        return
+    wrap_prompt_queue(prompt_queue)
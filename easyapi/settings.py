@@ -1,5 +1,10 @@
+import atexit
+import copy
 import os
 import json
+import threading
+import time
+
 import execution
 
 extension_folder = os.path.dirname(os.path.realpath(__file__))
@@ -33,28 +38,142 @@ def reset_history_size(max_size=execution.MAXIMUM_HISTORY_SIZE, isStart=False):
 
 
 def get_settings(file="config/easyapi.json"):
-    configFile = check_dir(file)
-    setting = {}
-    if not os.path.exists(configFile):
-        with open(configFile, 'w+', encoding="utf-8") as file:
-            json.dump({}, file, indent=2)
-    else:
-        with open(configFile, 'r+', encoding="utf-8") as file:
-            setting = json.load(file)
+    """
+    读取配置，配置缓存在内存中，最多每CHECK_INTERVAL秒检查一次文件修改时间，文件被外部修改后重新加载
+    Returns: 配置的深拷贝，修改返回值不影响缓存中的配置
+    """
+    with _lock:
+        return copy.deepcopy(_cached_data(file))
+
+
+def get_setting_value(key, default=None, file="config/easyapi.json"):
+    """
+    读取单个配置项，只拷贝这一项
+    """
+    with _lock:
+        settings = _cached_data(file)
+        if settings and key in settings:
+            return copy.deepcopy(settings[key])
+    return default
+
 
-    return setting
+def _cached_data(file):
+    """
+    缓存中的配置，调用方需持有_lock，不能修改返回值
+    """
+    configFile = check_dir(file)
+    entry = _cache.get(configFile)
+    if entry is None or (not entry["dirty"] and time.monotonic() - entry["checked"] >= CHECK_INTERVAL):
+        entry = _reload(configFile, entry)
+    return entry["data"]
 
 
 def set_settings(key, value, file="config/easyapi.json"):
+    """
+    修改配置，先更新内存中的配置，WRITE_DELAY秒后统一写入文件(多次修改只写一次)
+    """
+    global _version
     configFile = check_dir(file)
-    setting_json = get_settings(file=file)
-    setting_json[key] = value
-    with open(configFile, 'w+', encoding="utf-8") as file:
-        json.dump(setting_json, file, indent=2)
+    with _lock:
+        entry = _cache.get(configFile)
+        if entry is None:
+            entry = _reload(configFile, entry)
+        entry["data"][key] = copy.deepcopy(value)
+        entry["dirty"] = True
+        _version += 1
+        _schedule_flush()
+
+
+def settings_version():
+    """
+    配置的版本号，每次配置变化(修改或重新加载)时加1，不读取文件
+    """
+    return _version
+
+
+def flush_settings():
+    """
+    把修改过的配置写入文件，先写临时文件再重命名，保证文件内容完整
+    """
+    global _flush_timer
+    with _lock:
+        _flush_timer = None
+        for configFile, entry in _cache.items():
+            if not entry["dirty"]:
+                continue
+            try:
+                _write_atomic(configFile, entry["data"])
+                entry["mtime"] = os.stat(configFile).st_mtime_ns
+                entry["checked"] = time.monotonic()
+                entry["dirty"] = False
+            except OSError as e:
+                print(f"[easyapi] fail to save settings {configFile}, error: {e}")
 
 
 def check_dir(filePath):
     configDataFilePath = os.path.join(extension_folder, os.path.dirname(filePath))
-    if not os.path.exists(configDataFilePath):
-        os.mkdir(configDataFilePath)
+    if configDataFilePath not in _checked_dirs:
+        os.makedirs(configDataFilePath, exist_ok=True)
+        _checked_dirs.add(configDataFilePath)
     return os.path.join(configDataFilePath, os.path.basename(filePath))
+
+
+# 检查配置文件是否被外部修改的间隔(秒)
+CHECK_INTERVAL = 1.0
+# 修改配置后延迟写入文件的时间(秒)
+WRITE_DELAY = 0.5
+
+_lock = threading.RLock()
+# key是配置文件路径，值是{"data": 配置, "mtime": 文件修改时间, "checked": 上次检查时间, "dirty": 是否有未写入的修改}
+_cache = {}
+_checked_dirs = set()
+_version = 0
+_flush_timer = None
+
+
+def _reload(configFile, entry):
+    global _version
+    try:
+        mtime = os.stat(configFile).st_mtime_ns
+    except FileNotFoundError:
+        mtime = None
+    if entry is not None and mtime == entry["mtime"]:
+        entry["checked"] = time.monotonic()
+        return entry
+
+    data = {}
+    if mtime is None:
+        _write_atomic(configFile, data)
+        mtime = os.stat(configFile).st_mtime_ns
+    else:
+        try:
+            with open(configFile, 'r', encoding="utf-8") as file:
+                data = json.load(file)
+        except ValueError as e:
+            # 文件内容不完整时保留之前的配置
+            print(f"[easyapi] fail to load settings {configFile}, error: {e}")
+            if entry is not None:
+                data = entry["data"]
+    entry = {"data": data, "mtime": mtime, "checked": time.monotonic(), "dirty": False}
+    _cache[configFile] = entry
+    _version += 1
+    return entry
+
+
+def _write_atomic(configFile, data):
+    tmpFile = "{}.{}.tmp".format(configFile, os.getpid())
+    with open(tmpFile, 'w', encoding="utf-8") as file:
+        json.dump(data, file, indent=2)
+    os.replace(tmpFile, configFile)
+
+
+def _schedule_flush():
+    global _flush_timer
+    if _flush_timer is not None:
+        _flush_timer.cancel()
+    _flush_timer = threading.Timer(WRITE_DELAY, flush_settings)
+    _flush_timer.daemon = True
+    _flush_timer.start()
+
+
+atexit.register(flush_settings)
@@ -0,0 +1,217 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .cache import register_cache
+from .settings import get_setting_value
+
+extension_folder = os.path.dirname(os.path.realpath(__file__))
+
+
+class UrlDiskCache:
+    """
+    远程文件的磁盘缓存。
+    数据文件以内容的sha256命名(相同内容只保存一份)，每个url对应一个记录文件，保存ETag/Last-Modified和数据文件的sha256。
+    再次请求时带上If-None-Match/If-Modified-Since发送条件请求，服务端返回304时直接读取本地文件。
+    超过容量上限时按最近访问时间淘汰数据文件。
+    """
+
+    def __init__(self, name, cache_dir):
+        self.name = name
+        self.cache_dir = cache_dir
+        self.meta_dir = os.path.join(cache_dir, "meta")
+        self.data_dir = os.path.join(cache_dir, "data")
+        # 数据文件的访问顺序，key是sha256，值是文件大小
+        self._data = None
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.evictions = 0
+        register_cache(name, self)
+
+    @property
+    def enabled(self):
+        return bool(get_setting_value("url_cache_enabled", True))
+
+    @property
+    def max_bytes(self):
+        return int(float(get_setting_value("url_cache_max_size", 1024)) * 1024 * 1024)
+
+    def _load(self):
+        """
+        首次使用时扫描数据目录，按修改时间(即最近访问时间)恢复访问顺序
+        """
+        if self._data is not None:
+            return
+        os.makedirs(self.meta_dir, exist_ok=True)
+        os.makedirs(self.data_dir, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.data_dir):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        entries.sort()
+        self._data = OrderedDict((digest, size) for _, digest, size in entries)
+        self._size = sum(size for _, _, size in entries)
+
+    def _meta_path(self, url):
+        return os.path.join(self.meta_dir, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def _data_path(self, digest):
+        return os.path.join(self.data_dir, digest)
+
+    def _read_meta(self, url):
+        try:
+            with open(self._meta_path(url), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            if meta.get("url") != url or meta.get("digest") not in self._data:
+                return None
+        return meta
+
+    def _read_data(self, digest):
+        with open(self._data_path(digest), "rb") as f:
+            content = f.read()
+        now = time.time()
+        os.utime(self._data_path(digest), (now, now))
+        with self._lock:
+            if digest in self._data:
+                self._data.move_to_end(digest)
+        return content
+
+    def _store(self, url, content, digest, etag, last_modified):
+        data_path = self._data_path(digest)
+        with self._lock:
+            exists = digest in self._data
+        if not exists:
+            write_file_atomic(data_path, content)
+        meta = {"url": url, "digest": digest, "etag": etag, "last_modified": last_modified, "time": time.time()}
+        write_file_atomic(self._meta_path(url), json.dumps(meta).encode("utf-8"))
+        with self._lock:
+            if digest not in self._data:
+                self._data[digest] = len(content)
+                self._size += len(content)
+            self._data.move_to_end(digest)
+        self._evict()
+
+    def _evict(self):
+        max_bytes = self.max_bytes
+        removed = []
+        with self._lock:
+            while self._size > max_bytes and len(self._data) > 0:
+                digest, size = self._data.popitem(last=False)
+                self._size -= size
+                self.evictions += 1
+                removed.append(digest)
+        # 记录文件指向的数据文件不存在时会当作未缓存处理
+        for digest in removed:
+            try:
+                os.remove(self._data_path(digest))
+            except OSError:
+                pass
+
+    def fetch(self, url, session, timeout=None):
+        """
+        读取url的内容，优先使用缓存
+        Returns: (内容, 内容的sha256)
+        """
+        if not self.enabled:
+            response = session.get(url, timeout=timeout, verify=False)
+            response.raise_for_status()
+            with self._lock:
+                self.misses += 1
+            return response.content, hashlib.sha256(response.content).hexdigest()
+
+        with self._lock:
+            self._load()
+        meta = self._read_meta(url)
+        headers = {}
+        if meta is not None:
+            # 在max_age秒内不发送条件请求，直接使用缓存
+            max_age = float(get_setting_value("url_cache_max_age", 0))
+            if time.time() - meta["time"] < max_age:
+                try:
+                    content = self._read_data(meta["digest"])
+                    with self._lock:
+                        self.hits += 1
+                    return content, meta["digest"]
+                except OSError:
+                    meta = None
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        response = session.get(url, headers=headers, timeout=timeout, verify=False)
+        if response.status_code == 304 and meta is not None:
+            try:
+                content = self._read_data(meta["digest"])
+                with self._lock:
+                    self.hits += 1
+                    self.revalidated += 1
+                return content, meta["digest"]
+            except OSError:
+                # 数据文件已被淘汰，重新下载
+                response = session.get(url, timeout=timeout, verify=False)
+        response.raise_for_status()
+        with self._lock:
+            self.misses += 1
+        content = response.content
+        digest = hashlib.sha256(content).hexdigest()
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        # 没有校验信息的响应无法发送条件请求，不缓存
+        if etag or last_modified:
+            try:
+                self._store(url, content, digest, etag, last_modified)
+            except OSError as e:
+                print(f"[easyapi] fail to cache url {url}, error: {e}")
+        return content, digest
+
+    def clear(self):
+        with self._lock:
+            self._load()
+            digests = list(self._data.keys())
+            self._data.clear()
+            self._size = 0
+        for digest in digests:
+            try:
+                os.remove(self._data_path(digest))
+            except OSError:
+                pass
+        for entry in os.scandir(self.meta_dir):
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            self._load()
+            return {
+                "entries": len(self._data),
+                "size": self._size,
+                "max_size": self.max_bytes,
+                "hits": self.hits,
+                "revalidated": self.revalidated,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def write_file_atomic(path, content):
+    tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+url_cache = UrlDiskCache("url", get_setting_value("url_cache_dir", os.path.join(extension_folder, "cache", "url")))
@@ -2,22 +2,83 @@ import base64
 import io
 import json
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-import requests
 import torch
 from PIL import Image
 
+from .cache import LRUCache, sizeof_tensors
+from .settings import get_setting_value
+from .urlCache import url_cache
+
+# 支持的编码格式: (PIL格式, mime类型, 文件扩展名)
+image_formats = {
+    "png": ("PNG", "image/png", "png"),
+    "webp": ("WEBP", "image/webp", "webp"),
+    "jpeg": ("JPEG", "image/jpeg", "jpg"),
+}
+
+
+def tensor_to_uint8(images):
+    """
+    把0~1的浮点图片张量(任意形状，如[B,H,W,C])一次性量化为uint8的numpy数组。
+    在张量所在设备上完成乘法和截断，只有一次中间张量的分配，后续操作都是原地进行，不修改输入张量
+    """
+    images = images.detach()
+    if images.dtype == torch.uint8:
+        return images.cpu().numpy()
+    quantized = images.mul(255.)
+    quantized.clamp_(0, 255)
+    return quantized.to(torch.uint8).cpu().numpy()
+
 
 # Tensor to PIL
 def tensor_to_pil(image):
-    return Image.fromarray(np.clip(255. * image.cpu().numpy().squeeze(), 0, 255).astype(np.uint8))
+    return Image.fromarray(tensor_to_uint8(image).squeeze())
 
 
 # Convert PIL to Tensor
 def pil_to_tensor(image):
-    return torch.from_numpy(np.array(image).astype(np.float32) / 255.0).unsqueeze(0)
+    """
+    PIL图片或uint8数组转为[1,H,W,C]的浮点张量
+    """
+    return torch.from_numpy(np.array(image)).to(torch.float32).div_(255.0).unsqueeze(0)
+
+
+def pils_to_tensor(images):
+    """
+    尺寸相同的PIL图片(或uint8数组)列表转为[B,H,W,C]的浮点张量，输出张量只分配一次
+    """
+    first = np.array(images[0])
+    output = torch.empty((len(images),) + first.shape, dtype=torch.float32)
+    for (index, image) in enumerate(images):
+        array = first if index == 0 else np.array(image)
+        if array.shape != first.shape:
+            raise ValueError(f"image size mismatch: {array.shape} != {first.shape}")
+        output[index].copy_(torch.from_numpy(array))
+    return output.div_(255.0)
+
+
+def pils_to_tensors(images):
+    """
+    PIL图片列表转为[1,H,W,C]浮点张量的列表，尺寸都相同时解码到一个预先分配的[B,H,W,C]张量中，列表中的元素是它的视图
+    """
+    if len(images) > 1 and all(image.size == images[0].size for image in images):
+        return list(pils_to_tensor(images).split(1))
+    return [pil_to_tensor(image) for image in images]
+
+
+def pil_to_mask(image, channel="A"):
+    """
+    取PIL图片的某个通道作为遮罩[H,W]，alpha通道会反转(透明区域为1)
+    """
+    mask = torch.from_numpy(np.array(image.getchannel(channel))).to(torch.float32).div_(255.0)
+    if channel == "A":
+        mask = mask.neg_().add_(1.)
+    return mask
 
 
 def base64_to_image(base64_string):
@@ -40,34 +101,130 @@ def base64_to_image(base64_string):
     return image
 
 
-def image_to_base64(pli_image, pnginfo=None):
+def save_image(pli_image, fp, image_format="png", compress_level=6, quality=90, pnginfo=None):
+    """
+    按指定格式保存图片，png使用compress_level，webp和jpeg使用quality，元数据只在png中保存
+    Args:
+        fp: 文件路径或文件对象
+    """
+    if image_format == "png":
+        pli_image.save(fp, format="PNG", pnginfo=pnginfo, compress_level=compress_level)
+    else:
+        if image_format == "jpeg" and pli_image.mode not in ("RGB", "L"):
+            pli_image = pli_image.convert("RGB")
+        pli_image.save(fp, format=image_formats[image_format][0], quality=quality)
+
+
+def image_to_bytes(pli_image, pnginfo=None, image_format="png", compress_level=6, quality=90):
     # 创建一个BytesIO对象，用于临时存储图像数据
     image_data = io.BytesIO()
 
-    # 将图像保存到BytesIO对象中，格式为PNG
-    pli_image.save(image_data, format='PNG', pnginfo=pnginfo)
+    # 将图像保存到BytesIO对象中
+    save_image(pli_image, image_data, image_format=image_format, compress_level=compress_level, quality=quality, pnginfo=pnginfo)
 
     # 将BytesIO对象的内容转换为字节串
-    image_data_bytes = image_data.getvalue()
+    return image_data.getvalue()
+
+
+def image_to_base64(pli_image, pnginfo=None, image_format="png", compress_level=6, quality=90):
+    image_data_bytes = image_to_bytes(pli_image, pnginfo=pnginfo, image_format=image_format, compress_level=compress_level, quality=quality)
 
     # 将图像数据编码为Base64字符串
-    encoded_image = "data:image/png;base64," + base64.b64encode(image_data_bytes).decode('utf-8')
+    mime_type = image_formats[image_format][1]
+    encoded_image = "data:" + mime_type + ";base64," + base64.b64encode(image_data_bytes).decode('utf-8')
 
     return encoded_image
 
 
+# 共享线程池，key是线程池名称
+_thread_pools = {}
+_thread_pools_lock = threading.Lock()
+
+
+def get_thread_pool(name, size_key, default_size):
+    """
+    获取共享线程池，线程数通过配置项size_key设置，只在第一次使用时读取，修改后需重启。
+    运行中不重建线程池，其他线程可能还在向旧的线程池提交任务
+    """
+    with _thread_pools_lock:
+        pool = _thread_pools.get(name)
+        if pool is None:
+            size = max(1, int(get_setting_value(size_key, default_size)))
+            pool = _thread_pools[name] = ThreadPoolExecutor(max_workers=size, thread_name_prefix="easyapi_" + name)
+        return pool
+
+
+def get_encoder_pool():
+    """
+    图片编码共享线程池，zlib/libwebp/libjpeg编码时会释放GIL，批量图片可以并行编码。
+    线程数通过配置项encoder_pool_size设置，默认为min(4, cpu核数)
+    """
+    return get_thread_pool("encoder", "encoder_pool_size", min(4, os.cpu_count() or 1))
+
+
+def get_prompt_pool():
+    """
+    解析和校验prompt的共享线程池，避免大的workflow阻塞事件循环。线程数通过配置项prompt_pool_size设置，默认为2
+    """
+    return get_thread_pool("prompt", "prompt_pool_size", 2)
+
+
+def map_in_pool(pool, func, items):
+    """
+    在线程池中对每个元素执行func，结果顺序与items一致
+    """
+    items = list(items)
+    if len(items) <= 1:
+        return [func(item) for item in items]
+    return list(pool.map(func, items))
+
+
+def encode_in_pool(func, items):
+    return map_in_pool(get_encoder_pool(), func, items)
+
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """
+    共享的http连接池，保持长连接，失败时按指数退避重试。
+    重试次数通过配置项url_fetch_retries设置(默认3)，修改后需重启
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retries = int(get_setting_value("url_fetch_retries", 3))
+            retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=frozenset(["GET", "HEAD"]))
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _http_session = session
+        return _http_session
+
+
+def read_url_content(url):
+    """
+    读取url的内容，优先使用磁盘缓存
+    Returns: (内容, 内容的sha256)
+    """
+    # 连接和读取超时时间(秒)，通过配置项url_fetch_timeout设置
+    timeout = float(get_setting_value("url_fetch_timeout", 30))
+    return url_cache.fetch(url, get_http_session(), timeout=timeout)
+
+
 def read_image_from_url(image_url):
     try:
-        # Create a new session and disable keep-alive if desired
-        session = requests.Session()
-        session.keep_alive = False
-
-        # Get the image content from the URL
-        response = session.get(image_url, stream=True, verify=False)
-        response.raise_for_status()  # Ensure we got a valid response
+        content, _ = read_url_content(image_url)
 
         # Convert the response content into a BytesIO object
-        image_bytes = io.BytesIO(response.content)
+        image_bytes = io.BytesIO(content)
         
         # Open the image using PIL and force loading the image data
         img = Image.open(image_bytes)
@@ -79,6 +236,43 @@ def read_image_from_url(image_url):
         return None
 
 
+# 网络图片解码后的张量缓存，默认不开启(容量为0)
+url_decoded_cache = LRUCache("url_decoded", "url_decoded_cache_max_size", 0, sizeof=sizeof_tensors)
+
+
+def read_images_from_urls(urls, convert=None, convert_key=None):
+    """
+    并发下载图片，下载完成后在同一个工作线程中解码并执行convert，结果顺序与urls一致。
+    并发数通过配置项url_fetch_workers设置，默认为8
+    Args:
+        urls: 图片地址列表
+        convert: 对解码后的PIL图片执行的转换函数，图片加载失败时不执行
+        convert_key: convert的标识，不为空时按(内容sha256, convert_key)缓存convert的结果
+
+    Returns: 结果列表，加载失败的为None
+    """
+    def load(url):
+        try:
+            content, digest = read_url_content(url)
+            if convert_key is not None:
+                result = url_decoded_cache.get((digest, convert_key))
+                if result is not None:
+                    return result
+            img = Image.open(io.BytesIO(content))
+            img.load()
+        except Exception as e:
+            print(f"Error reading image from URL {url}: {e}")
+            return None
+        if convert is None:
+            return img
+        result = convert(img)
+        if convert_key is not None:
+            url_decoded_cache.put((digest, convert_key), result)
+        return result
+
+    return map_in_pool(get_thread_pool("url_fetch", "url_fetch_workers", 8), load, urls)
+
+
 def hex_to_rgba(hex_color):
     hex_color = hex_color.lstrip('#')
     r, g, b = tuple(int(hex_color[i:i + 2], 16) for i in (0, 2, 4))